@@ -0,0 +1,179 @@
+import importlib.util
+import random
+import re
+import time
+
+import pandas as pd
+
+# =========================================================
+# load imc-unit-matching.py (hyphenated name, not importable directly)
+# =========================================================
+spec = importlib.util.spec_from_file_location("imc_unit_matching", "./imc-unit-matching.py")
+imc = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(imc)
+
+
+# =========================================================
+# reference classifier + matcher: the original hard-coded helpers and the
+# modules × courses × codes scan
+# =========================================================
+combine_unit_pattern = re.compile(r"[A-Z]{3,4}\d{3}(?:/[A-Z]{3,4}\d{3})+")
+single_unit_pattern = re.compile(r"[A-Z]{3,4}\d{3}")
+stream_pattern = re.compile(r"Stream\s*(\d+)", re.IGNORECASE)
+
+
+def detect_campus(name):
+    name = str(name).upper()
+    if " WA " in name:
+        return "WA"
+    elif " TAS " in name:
+        return "TAS"
+    return "SYD"
+
+
+def detect_stream(name):
+    match = stream_pattern.search(name)
+    return f"Stream{match.group(1)}" if match else "Stream1"
+
+
+def extract_codes(text):
+    if not isinstance(text, str):
+        return []
+    match = combine_unit_pattern.search(text)
+    if match:
+        return match.group(0).split("/")
+    match = single_unit_pattern.search(text)
+    return [match.group(0)] if match else []
+
+
+def get_campuses(key, text):
+    match = re.search(r"\((SYD|WA|TAS)(?:/(SYD|WA|TAS))*\)", str(text))
+    if match:
+        campuses = re.findall(r"(SYD|WA|TAS)", match.group(0))
+        return sorted(set(campuses))
+    elif "WA" in str(key):
+        return ["WA"]
+    elif "TAS" in str(key):
+        return ["TAS"]
+    else:
+        return ["SYD"]
+
+
+def get_stream(desc):
+    if "Class 1" in str(desc):
+        return "Stream1"
+    elif "Class 2" in str(desc):
+        return "Stream2"
+    else:
+        return "Stream1"
+
+
+def build_campus_tree_legacy(df):
+    campus_tree = {
+        "WA": {"Stream1": [], "Stream2": []},
+        "TAS": {"Stream1": [], "Stream2": []},
+        "SYD": {"Stream1": [], "Stream2": []},
+    }
+    filtered_df = df[~df["TimetableID"].str.contains("Tutorial", case=False, na=False)]
+    for course in filtered_df["TimetableID"].dropna().unique():
+        campus_tree[detect_campus(course)][detect_stream(course)].append(course)
+    return campus_tree
+
+
+def generate_mapping_scan(campus_tree, module_dict):
+    result = []
+    for short_name, full_name in module_dict.items():
+        codes = extract_codes(full_name)
+        if not codes:
+            continue
+        campuses = get_campuses(short_name, full_name)
+        stream = get_stream(full_name)
+        for campus in campuses:
+            if campus not in campus_tree or stream not in campus_tree[campus]:
+                continue
+            for course_name in campus_tree[campus][stream]:
+                if any(code in course_name for code in codes):
+                    result.append(
+                        {"timetable_id": course_name, "short_name": short_name}
+                    )
+    return result
+
+
+# =========================================================
+# synthetic timetable / unit creation sheets
+# =========================================================
+PREFIXES = ["ACC", "BUS", "ECO", "FIN", "MGT", "MKT", "LAW", "HRM", "ICT", "STAT", "PROJ"]
+CAMPUS_TAGS = ["", " WA ", " TAS "]
+KINDS = ["Lecture", "Workshop", "Tutorial", "Seminar"]
+
+
+def make_codes(n_codes, rng):
+    codes = set()
+    while len(codes) < n_codes:
+        codes.add(f"{rng.choice(PREFIXES)}{rng.randint(100, 999)}")
+    return sorted(codes)
+
+
+def make_timetable(n_rows, codes, rng):
+    rows = []
+    for i in range(n_rows):
+        code = rng.choice(codes)
+        if rng.random() < 0.15:
+            code = f"{code}/{rng.choice(codes)}"
+        stream = f"Stream {rng.randint(1, 2)}"
+        group = rng.randint(1, max(1, n_rows // 200))
+        timetable_id = f"{code}{rng.choice(CAMPUS_TAGS) or ' '}{stream} {rng.choice(KINDS)} G{group}"
+        rows.append({"TimetableID": timetable_id, "Email2": f"{100000 + i}@student.imc.edu.au"})
+    return pd.DataFrame(rows)
+
+
+def make_units(codes, rng):
+    rows = []
+    for code in codes:
+        campus = rng.choice(["SYD", "WA", "TAS", "SYD/WA", "SYD/WA/TAS"])
+        klass = rng.choice(["Class 1", "Class 2"])
+        rows.append(
+            {
+                "shortname": f"{code}-T3-{campus.replace('/', '')}-{klass[-1]}",
+                "fullname": f"{code} Unit Title ({campus}) {klass}",
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def bench(n_rows, n_codes=600, seed=0):
+    rng = random.Random(seed)
+    codes = make_codes(n_codes, rng)
+    df_current = make_timetable(n_rows, codes, rng)
+    df_unit = make_units(codes, rng)
+
+    t0 = time.perf_counter()
+    campus_tree, code_index = imc.build_campus_tree(df_current)
+    t_tree = time.perf_counter() - t0
+    module_dict = imc.build_module_dict(df_unit)
+
+    legacy_tree = build_campus_tree_legacy(df_current)
+    assert {c: {s: v for s, v in t.items() if v} for c, t in legacy_tree.items()} == campus_tree, (
+        "classifier diverged from the legacy campus/stream helpers"
+    )
+
+    t0 = time.perf_counter()
+    old = generate_mapping_scan(legacy_tree, module_dict)
+    t_old = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new = imc.generate_mapping(campus_tree, module_dict, code_index)
+    t_new = time.perf_counter() - t0
+
+    assert old == new, "indexed matcher diverged from the reference scan"
+    n_courses = sum(len(v) for s in campus_tree.values() for v in s.values())
+    print(
+        f"{n_rows:>7} rows | {n_courses:>6} courses | {len(module_dict):>4} modules | "
+        f"{len(new):>6} pairs | tree+index {t_tree:7.3f}s | "
+        f"scan {t_old:7.3f}s | indexed {t_new:7.3f}s | x{t_old / max(t_new, 1e-9):.1f}"
+    )
+
+
+if __name__ == "__main__":
+    for n in (10_000, 100_000):
+        bench(n)
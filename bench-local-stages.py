@@ -0,0 +1,202 @@
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import pandas as pd
+
+
+# =========================================================
+# load the hyphenated sibling scripts
+# =========================================================
+def load_script(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+imc = load_script("imc_unit_matching", "./imc-unit-matching.py")
+synth = load_script("bench_generate_mapping", "./bench-generate-mapping.py")
+
+
+# =========================================================
+# reference implementations: the original iterrows / full-merge versions
+# =========================================================
+def build_module_dict_iterrows(df):
+    mapping = {}
+    for _, row in df.iterrows():
+        shortname = row.get("shortname")
+        fullname = row.get("fullname")
+        if pd.notna(shortname) and pd.notna(fullname):
+            mapping[shortname.strip()] = fullname.strip()
+    return mapping
+
+
+def match_enrolments_full_merge(df_current, df_unit):
+    campus_tree, code_index = imc.build_campus_tree(df_current)
+    module_dict = build_module_dict_iterrows(df_unit)
+    result = imc.generate_mapping(campus_tree, module_dict, code_index)
+    result_df = pd.DataFrame(result).rename(columns={"timetable_id": "TimetableID"})
+    merged_df = pd.merge(df_current, result_df, on="TimetableID", how="inner")
+    return merged_df[["Email2", "short_name"]].rename(columns={"Email2": "email"})
+
+
+def build_target_enrol_iterrows(final_df, course_map):
+    final_df = final_df[final_df["short_name"].isin(course_map.keys())]
+    final_df["course_id"] = final_df["short_name"].map(course_map)
+
+    target_enrol = {}
+    for _, row in final_df.iterrows():
+        email = row["email"]
+        course_id = row["course_id"]
+        target_enrol.setdefault(course_id, set()).add(email)
+    return target_enrol
+
+
+def exact_string_churn(course_map, current, target, to_enrol, to_unenrol):
+    """Reference for imc.normalisation_churn: multiset difference of the two diffs' records."""
+    churn = {}
+    for kind, records in (("enrol", to_enrol), ("unenrol", to_unenrol)):
+        raw = Counter()
+        for course_id in course_map.values():
+            cur, tgt = current.get(course_id, set()), target.get(course_id, set())
+            emails = tgt - cur if kind == "enrol" else [e for e in cur - tgt if imc.is_student_email(e)]
+            raw.update((course_id, imc.canonical_email(e)) for e in emails)
+        ours = Counter((r["course_id"], r["email"]) for r in records)
+        churn[kind] = (sum((raw - ours).values()), sum((ours - raw).values()))
+    return churn
+
+
+def check_normalisation_churn(n_cases=200, seed=0):
+    """Respelled emails: the reported churn must equal the exact-string reference, whatever the order."""
+    rng = random.Random(seed)
+    people = [f"{100000 + i}@student.imc.edu.au" for i in range(30)] + [f"staff{i}@imc.edu.au" for i in range(5)]
+
+    def spell(email):
+        return rng.choice([email, email, email.upper(), f" {email}", f"{email} "])
+
+    # the respelled form is interned first, with no other spelling of it anywhere
+    cases = [({1: {" 100001@student.imc.edu.au", "100002@student.imc.edu.au"}}, {1: {"100002@student.imc.edu.au"}})]
+    for _ in range(n_cases):
+        courses = range(1, rng.randint(1, 4) + 1)
+        cases.append((
+            {c: {spell(e) for e in rng.sample(people, 8)} for c in courses},
+            {c: {spell(e) for e in rng.sample(people, 8)} for c in courses},
+        ))
+    for current, target in cases:
+        course_map = {f"C{c}": c for c in current}
+        with contextlib.redirect_stdout(io.StringIO()):  # the per-case 🧹 summaries
+            to_enrol, to_unenrol = imc.diff_enrolments(course_map, current, target)
+        interner = imc.EmailInterner()
+        respelled = imc.intern_memberships(current, interner)[1] | imc.intern_memberships(target, interner)[1]
+        expected = exact_string_churn(course_map, current, target, to_enrol, to_unenrol)
+        assert imc.normalisation_churn(respelled, current, target, to_enrol, to_unenrol) == expected, (
+            current, target, expected
+        )
+    print(f"normalisation churn matches the exact-string reference in {len(cases)} cases")
+
+
+# =========================================================
+# regression check + timing
+# =========================================================
+# fixed, so a larger export shows whether streamed peak memory stays flat
+STREAM_CHUNK_ROWS = 5_000
+# one term's timetable: more rows means more enrolments in the same classes
+TERM_CODES = 600
+TERM_CLASSES = 5_000
+
+
+def make_enrolments(n_rows, codes, rng):
+    """n_rows (TimetableID, Email2) rows spread over a fixed TERM_CLASSES timetable."""
+    classes = synth.make_timetable(TERM_CLASSES, codes, rng)["TimetableID"].tolist()
+    return pd.DataFrame(
+        {
+            "TimetableID": [rng.choice(classes) for _ in range(n_rows)],
+            "Email2": [f"{100000 + rng.randrange(max(1, n_rows // 4))}@student.imc.edu.au" for _ in range(n_rows)],
+        }
+    )
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
+
+
+def bench(n_rows, seed=0):
+    rng = random.Random(seed)
+    codes = synth.make_codes(TERM_CODES, rng)
+    df_current = make_enrolments(n_rows, codes, rng)
+    # a few blank rows, like the real exports have
+    df_unit = pd.concat(
+        [synth.make_units(codes, rng), pd.DataFrame({"shortname": [None], "fullname": ["X"]})],
+        ignore_index=True,
+    )
+    # only some units exist in Moodle
+    shortnames = df_unit["shortname"].dropna().tolist()
+    course_map = {s: 1000 + i for i, s in enumerate(shortnames) if rng.random() < 0.9}
+
+    old_dict, t_dict_old = timed(build_module_dict_iterrows, df_unit)
+    new_dict, t_dict_new = timed(imc.build_module_dict, df_unit)
+    assert list(old_dict.items()) == list(new_dict.items()), "build_module_dict diverged"
+
+    old_final, t_match_old = timed(match_enrolments_full_merge, df_current, df_unit)
+    new_final, t_match_new = timed(imc.match_enrolments, df_current, df_unit)
+    assert old_final.reset_index(drop=True).equals(new_final.reset_index(drop=True)), (
+        "match_enrolments diverged"
+    )
+
+    old_target, t_target_old = timed(build_target_enrol_iterrows, old_final, course_map)
+    new_target, t_target_new = timed(imc.build_target_enrol, new_final, course_map)
+    assert old_target == new_target, "build_target_enrol diverged"
+
+    print(
+        f"{n_rows:>7} rows | module_dict {t_dict_old:6.3f}s -> {t_dict_new:6.3f}s | "
+        f"match {t_match_old:6.3f}s -> {t_match_new:6.3f}s | "
+        f"target {t_target_old:6.3f}s -> {t_target_new:6.3f}s | outputs identical"
+    )
+
+    # streaming mode: same target sets, peak memory bounded by the chunk size
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "current.csv")
+        df_current.to_csv(path, index=False)
+
+        def whole():
+            return imc.build_target_enrol(imc.match_enrolments(pd.read_csv(path), df_unit), course_map)
+
+        def streamed():
+            return imc.stream_target_enrol(
+                path, imc.build_module_dict(df_unit), course_map, chunk_rows=STREAM_CHUNK_ROWS
+            )
+
+        # timed untraced: tracemalloc slows allocation-heavy code several-fold;
+        # the target sets are the result, so the peak is shown next to their size
+        peaks = {}
+        for name, fn in (("whole", whole), ("stream", streamed)):
+            result, elapsed = timed(fn)
+            tracemalloc.start()
+            kept = fn()
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del kept
+            peaks[name] = (result, elapsed, peak / 2**20, held / 2**20)
+        assert peaks["whole"][0] == peaks["stream"][0] == new_target, "stream_target_enrol diverged"
+        print(
+            f"{'':>7}      | whole-file {peaks['whole'][1]:6.3f}s {peaks['whole'][2]:7.1f} MB peak | "
+            f"streamed {peaks['stream'][1]:6.3f}s {peaks['stream'][2]:7.1f} MB peak | "
+            f"{peaks['stream'][3]:5.1f} MB target sets | outputs identical"
+        )
+
+
+if __name__ == "__main__":
+    check_normalisation_churn()
+    for n in (10_000, 100_000, 300_000):
+        bench(n)
@@ -0,0 +1,159 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+# =========================================================
+# load the hyphenated sibling scripts
+# =========================================================
+def load_script(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+imc = load_script("imc_unit_matching", "./imc-unit-matching.py")
+fake = load_script("fake_moodle", "./fake-moodle.py")
+synth = load_script("bench_generate_mapping", "./bench-generate-mapping.py")
+
+
+# =========================================================
+# synthetic inputs and Moodle seed
+# =========================================================
+def make_inputs(n_rows, workdir, seed=0):
+    rng = random.Random(seed)
+    codes = synth.make_codes(max(50, n_rows // 100), rng)
+    df_current = synth.make_timetable(n_rows, codes, rng)
+    # students take several classes each
+    n_students = max(1, n_rows // 4)
+    df_current["Email2"] = [
+        f"{100000 + rng.randrange(n_students)}@student.imc.edu.au" for _ in range(n_rows)
+    ]
+    df_unit = synth.make_units(codes, rng)
+
+    current_path = os.path.join(workdir, f"current-{n_rows}.xlsx")
+    unit_path = os.path.join(workdir, f"unit-{n_rows}.xlsx")
+    df_current.to_excel(current_path, index=False)
+    df_unit.to_excel(unit_path, index=False)
+    return current_path, unit_path, df_current, df_unit
+
+
+def make_seed(df_current, df_unit, seed=0, drift=0.05):
+    """Moodle state that is the target enrolment with `drift` noise both ways."""
+    rng = random.Random(seed)
+    courses = [
+        {"id": 1000 + i, "shortname": s}
+        for i, s in enumerate(df_unit["shortname"].dropna().unique())
+    ]
+    course_map = {c["shortname"]: c["id"] for c in courses}
+    emails = sorted(set(df_current["Email2"].dropna()))
+    users = [{"id": 1 + i, "email": e} for i, e in enumerate(emails)]
+    user_ids = {u["email"]: u["id"] for u in users}
+
+    target = imc.build_target_enrol(imc.match_enrolments(df_current, df_unit), course_map)
+    enrolments = {}
+    for course_id, members in target.items():
+        kept = {user_ids[e] for e in members if rng.random() >= drift}
+        extra = {rng.choice(users)["id"] for _ in range(int(len(members) * drift))}
+        enrolments[course_id] = sorted(kept | extra)
+    return {"courses": courses, "users": users, "enrolments": enrolments}
+
+
+# =========================================================
+# staged run
+# =========================================================
+class StageTimer:
+    def __init__(self, server):
+        self.server = server
+        self.rows = []
+
+    def run(self, name, fn, *args, **kwargs):
+        calls_before = sum(self.server.calls.values())
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        wall = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        calls = sum(self.server.calls.values()) - calls_before
+        self.rows.append((name, wall, calls, (peak - base) / 2**20))
+        return result
+
+    def report(self, title):
+        print(f"\n📊 {title}")
+        print(f"{'stage':<14}{'wall s':>10}{'API calls':>12}{'peak MB':>10}")
+        for name, wall, calls, peak in self.rows:
+            print(f"{name:<14}{wall:>10.3f}{calls:>12}{peak:>10.1f}")
+        total = sum(r[1] for r in self.rows), sum(r[2] for r in self.rows)
+        print(f"{'total':<14}{total[0]:>10.3f}{total[1]:>12}")
+
+
+def bench(n_rows, args, workdir):
+    current_path, unit_path, df_current, df_unit = make_inputs(n_rows, workdir)
+    server = fake.FakeMoodleServer(
+        fake.FakeMoodle(make_seed(df_current, df_unit)),
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+    )
+    client = imc.MoodleClient(server.start(), "bench-token", concurrency=args.concurrency)
+    cache_dir = os.path.join(workdir, f"cache-{n_rows}")
+    timer = StageTimer(server)
+
+    tracemalloc.start()
+    try:
+        df_current = timer.run("load", imc.load_sheet, current_path, imc.CURRENT_COLUMNS, cache_dir)
+        df_unit = timer.run("load_units", imc.load_sheet, unit_path, imc.UNIT_COLUMNS, cache_dir)
+        final_df = timer.run("match", imc.match_enrolments, df_current, df_unit)
+        shortnames = df_unit["shortname"].dropna().unique().tolist()
+        course_map = timer.run("course_ids", imc.fetch_course_ids, client, shortnames)
+        target_enrol = timer.run("target", imc.build_target_enrol, final_df, course_map)
+        enrolled_data = timer.run("enrolled", imc.fetch_enrolled_emails, client, course_map)
+        to_enrol, to_unenrol = timer.run(
+            "diff", imc.diff_enrolments, course_map, enrolled_data, target_enrol
+        )
+        emails = list({i["email"].lower() for i in to_enrol + to_unenrol})
+        user_cache = timer.run("user_ids", imc.fetch_user_ids_bulk, client, emails)
+        if args.apply:
+            timer.run(
+                "enrol", imc.run_enrolment_batches, client, "enrol_manual_enrol_users",
+                imc.resolve_user_ids(to_enrol, user_cache), role_id=imc.STUDENT_ROLE_ID,
+            )
+            timer.run(
+                "unenrol", imc.run_enrolment_batches, client, "enrol_manual_unenrol_users",
+                imc.resolve_user_ids(to_unenrol, user_cache),
+            )
+    finally:
+        tracemalloc.stop()
+        client.close()
+        server.stop()
+
+    timer.report(
+        f"{n_rows} rows, {len(course_map)} units, {len(to_enrol)} to enrol, "
+        f"{len(to_unenrol)} to unenrol, concurrency {args.concurrency}"
+    )
+    client.stats.print_table()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against fake-moodle.py")
+    parser.add_argument("--scales", default="1000,10000,50000", help="comma separated row counts")
+    parser.add_argument("--concurrency", type=int, default=imc.MOODLE_CONCURRENCY)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--apply", action="store_true", help="also time the enrol/unenrol writes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_rows in (int(n) for n in args.scales.split(",")):
+            bench(n_rows, args, workdir)
@@ -0,0 +1,327 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# =========================================================
+# ① in-memory Moodle state
+# =========================================================
+nested_key_pattern = re.compile(r"^(\w+)\[(\d+)\](?:\[(\w+)\])?$")
+
+
+class FakeMoodle:
+    """Courses, users and manual enrolments held in plain dicts.
+
+    seed = {"courses": [{"id", "shortname"}], "users": [{"id", "email"}],
+            "enrolments": {course_id: [user_id, ...]}}
+    """
+
+    def __init__(self, seed, token=None):
+        self.token = token
+        self.lock = threading.Lock()
+        self.courses = {c["id"]: dict(c) for c in seed.get("courses", [])}
+        self.course_by_shortname = {c["shortname"]: c["id"] for c in self.courses.values()}
+        self.users = {u["id"]: dict(u) for u in seed.get("users", [])}
+        self.user_by_email = {u["email"].lower(): u["id"] for u in self.users.values()}
+        self.enrolments = {
+            int(course_id): set(user_ids)
+            for course_id, user_ids in seed.get("enrolments", {}).items()
+        }
+
+    # ----------------------------
+    # wsfunctions
+    # ----------------------------
+    def core_course_get_courses_by_field(self, params):
+        field, value = params.get("field", ""), params.get("value", "")
+        if not field:
+            courses = list(self.courses.values())
+        elif field == "shortname":
+            course_id = self.course_by_shortname.get(value)
+            courses = [self.courses[course_id]] if course_id is not None else []
+        elif field in ("id", "ids"):
+            ids = {int(v) for v in str(value).split(",") if v}
+            courses = [self.courses[i] for i in ids if i in self.courses]
+        else:
+            raise InvalidParameter(f"field {field} not supported")
+        return {
+            "courses": [
+                {"id": c["id"], "shortname": c["shortname"], "fullname": c.get("fullname", c["shortname"])}
+                for c in courses
+            ],
+            "warnings": [],
+        }
+
+    def core_enrol_get_enrolled_users(self, params):
+        course_id = int(params["courseid"])
+        if course_id not in self.courses:
+            raise InvalidParameter(f"course {course_id} does not exist")
+        options = {o["name"]: o["value"] for o in nested_list(params, "options")}
+        with self.lock:
+            user_ids = sorted(self.enrolments.get(course_id, ()))
+        start = int(options.get("limitfrom", 0))
+        limit = int(options.get("limitnumber", 0))
+        user_ids = user_ids[start:start + limit] if limit else user_ids[start:]
+
+        fields = [f.strip() for f in options["userfields"].split(",")] if "userfields" in options else None
+        users = []
+        for user_id in user_ids:
+            user = full_profile(self.users[user_id])
+            if fields is not None:
+                user = {k: v for k, v in user.items() if k in fields or k in ("id", "fullname")}
+            users.append(user)
+        return users
+
+    def core_user_get_users_by_field(self, params):
+        if params.get("field") != "email":
+            raise InvalidParameter("only field=email is supported")
+        found = []
+        for entry in nested_list(params, "values"):
+            user_id = self.user_by_email.get(str(entry).lower())
+            if user_id is not None:
+                found.append({"id": user_id, "email": self.users[user_id]["email"]})
+        return found
+
+    def enrol_manual_enrol_users(self, params):
+        enrolments = self._validated_enrolments(params)
+        with self.lock:
+            for user_id, course_id in enrolments:
+                self.enrolments.setdefault(course_id, set()).add(user_id)
+        return None
+
+    def enrol_manual_unenrol_users(self, params):
+        enrolments = self._validated_enrolments(params)
+        with self.lock:
+            for user_id, course_id in enrolments:
+                self.enrolments.get(course_id, set()).discard(user_id)
+        return None
+
+    def _validated_enrolments(self, params):
+        # Moodle runs the whole batch in one transaction: one bad record fails all
+        enrolments = []
+        for entry in nested_list(params, "enrolments"):
+            user_id, course_id = int(entry["userid"]), int(entry["courseid"])
+            if user_id not in self.users:
+                raise InvalidParameter(f"user {user_id} does not exist")
+            if course_id not in self.courses:
+                raise InvalidParameter(f"course {course_id} does not exist")
+            enrolments.append((user_id, course_id))
+        return enrolments
+
+
+class InvalidParameter(Exception):
+    pass
+
+
+def nested_list(params, name):
+    """Rebuild name[i] / name[i][key] form fields into a list."""
+    items = {}
+    for key, value in params.items():
+        match = nested_key_pattern.match(key)
+        if not match or match.group(1) != name:
+            continue
+        idx = int(match.group(2))
+        if match.group(3) is None:
+            items[idx] = value
+        else:
+            items.setdefault(idx, {})[match.group(3)] = value
+    return [items[i] for i in sorted(items)]
+
+
+def full_profile(user):
+    # roughly what Moodle returns without userfields, so payload sizes are realistic
+    local = user["email"].split("@", 1)[0]
+    return {
+        "id": user["id"],
+        "username": local,
+        "fullname": f"User {local}",
+        "email": user["email"],
+        "department": "",
+        "firstaccess": 1700000000,
+        "lastaccess": 1700000000,
+        "description": "",
+        "profileimageurlsmall": f"https://moodle.invalid/user/{user['id']}/f2",
+        "profileimageurl": f"https://moodle.invalid/user/{user['id']}/f1",
+        "customfields": [{"type": "text", "value": "", "name": "Campus", "shortname": "campus"}],
+        "groups": [],
+        "roles": [{"roleid": 5, "name": "", "shortname": "student", "sortorder": 0}],
+        "enrolledcourses": [],
+    }
+
+
+# =========================================================
+# ② HTTP front end with latency, throttling and error injection
+# =========================================================
+class FakeMoodleServer:
+    def __init__(
+        self,
+        moodle,
+        host="127.0.0.1",
+        port=0,
+        latency_ms=0.0,
+        jitter_ms=0.0,
+        rate_limit=0.0,
+        error_rate=0.0,
+        seed=0,
+    ):
+        self.moodle = moodle
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.response_bytes = Counter()
+        self._stats_lock = threading.Lock()
+        self._tokens = rate_limit
+        self._last_refill = time.monotonic()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/webservice/rest/server.php"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.response_bytes.clear()
+
+    def _throttled(self):
+        if not self.rate_limit:
+            return False
+        with self._stats_lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit
+            )
+            self._last_refill = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def _inject_error(self):
+        if not self.error_rate:
+            return None
+        with self._stats_lock:
+            if self.rng.random() >= self.error_rate:
+                return None
+            return self.rng.choice(["http", "moodle"])
+
+    def dispatch(self, params):
+        """Returns (status, payload) for one request."""
+        wsfunction = params.get("wsfunction", "")
+        with self._stats_lock:
+            self.calls[wsfunction] += 1
+
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+        if self._throttled():
+            return 429, {"error": "Too Many Requests"}
+        injected = self._inject_error()
+        if injected == "http":
+            return 503, {"error": "Service Unavailable"}
+        if injected == "moodle":
+            return 200, moodle_exception("dmlreadexception", "Injected database read error")
+
+        if self.moodle.token and params.get("wstoken") != self.moodle.token:
+            return 200, moodle_exception("invalidtoken", "Invalid token - token not found")
+        handler = getattr(self.moodle, wsfunction, None) if not wsfunction.startswith("_") else None
+        if handler is None:
+            return 200, moodle_exception("invalidrecord", f"Can't find data record in database table external_functions. ({wsfunction})")
+        try:
+            return 200, handler(params)
+        except (InvalidParameter, KeyError, ValueError) as e:
+            return 200, moodle_exception("invalidparameter", f"Invalid parameter value detected ({e})")
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self._respond(dict(parse_qsl(urlparse(self.path).query, keep_blank_values=True)))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode()
+                params = dict(parse_qsl(urlparse(self.path).query, keep_blank_values=True))
+                params.update(parse_qsl(body, keep_blank_values=True))
+                self._respond(params)
+
+            def _respond(self, params):
+                status, payload = server.dispatch(params)
+                body = json.dumps(payload).encode()
+                with server._stats_lock:
+                    server.response_bytes[params.get("wsfunction", "")] += len(body)
+                    if status != 200 or (isinstance(payload, dict) and "exception" in payload):
+                        server.errors[params.get("wsfunction", "")] += 1
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def moodle_exception(errorcode, message):
+    return {"exception": "moodle_exception", "errorcode": errorcode, "message": message}
+
+
+# =========================================================
+# ③ Main Process
+# =========================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Moodle REST endpoint")
+    parser.add_argument("--seed-file", required=True, help="JSON with courses, users and enrolments")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", default=None, help="reject requests with any other wstoken")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second before HTTP 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    args = parser.parse_args()
+
+    with open(args.seed_file) as f:
+        moodle = FakeMoodle(json.load(f), token=args.token)
+    server = FakeMoodleServer(
+        moodle,
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+    )
+    print(f"🧪 Fake Moodle listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"📊 Calls: {dict(server.calls)}")
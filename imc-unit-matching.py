@@ -1,10 +1,49 @@
-import pandas as pd
 import re
-from tqdm import tqdm
 from dotenv import load_dotenv
 import os
-import requests
+import sys
 import time
+import threading
+import sqlite3
+import argparse
+import hashlib
+import importlib.util
+import pickle
+import json
+import bisect
+import random
+import contextlib
+import cProfile
+import tracemalloc
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+
+def lazy_import(name):
+    """Module whose real import runs on first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# heavy modules load on first use, so `unit` / `student` queries never import pandas
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+requests = lazy_import("requests")
+
+
+def tqdm(iterable=None, **kwargs):
+    from tqdm import tqdm as progress
+
+    return progress(iterable, **kwargs)
+
 
 # =========================================================
 # ① load environment variables
@@ -13,6 +52,28 @@ load_dotenv()
 
 MOODLE_URL = os.getenv("MOODLE_URL")
 MOODLE_TOKEN = os.getenv("MOODLE_TOKEN")
+MOODLE_CONCURRENCY = int(os.getenv("MOODLE_CONCURRENCY", "8"))
+MOODLE_RATE = float(os.getenv("MOODLE_RATE", "10"))  # starting requests/second
+MOODLE_RATE_MAX = float(os.getenv("MOODLE_RATE_MAX", "100"))
+MOODLE_MAX_RETRIES = int(os.getenv("MOODLE_MAX_RETRIES", "4"))
+ENROLLED_PAGE_SIZE = int(os.getenv("ENROLLED_PAGE_SIZE", "500"))
+ENROL_BATCH_SIZE = int(os.getenv("ENROL_BATCH_SIZE", "100"))
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL", "5"))  # seconds between input polls
+WATCH_RESYNC = float(os.getenv("WATCH_RESYNC_MINUTES", "60")) * 60
+APPLY_CHANGES = os.getenv("APPLY_CHANGES", "0") == "1"
+
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "50000"))
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "csv")  # comma separated: csv, jsonl, parquet, xlsx
+RESULT_ROW_GROUP = int(os.getenv("RESULT_ROW_GROUP", "50000"))
+PLAN_CHUNK_ROWS = int(os.getenv("PLAN_CHUNK_ROWS", "10000"))
+RECONCILE_SHARDS = int(os.getenv("RECONCILE_SHARDS", "1"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
+CACHE_DIR = os.getenv("CACHE_DIR", "./result")
+COURSE_CACHE_TTL = float(os.getenv("COURSE_CACHE_TTL_DAYS", "30")) * 86400
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL_DAYS", "30")) * 86400
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "200000"))
+
+STUDENT_ROLE_ID = 5  # Student role is 5
 
 # =========================================================
 # ② file paths
@@ -20,307 +81,2534 @@ MOODLE_TOKEN = os.getenv("MOODLE_TOKEN")
 file_path_current_enrolled_modules = "./files/Current Enrolled Modules T3.xlsx"
 file_path_unit_creation = "./files/Unit Creation 2025 T3.xlsx"
 
+# only the columns the pipeline reads
+CURRENT_COLUMNS = ["TimetableID", "Email2"]
+UNIT_COLUMNS = ["shortname", "fullname"]
+
 # =========================================================
-# ③ regex patterns
+# ③ spreadsheet ingestion
 # =========================================================
-combine_unit_pattern = re.compile(r"[A-Z]{3,4}\d{3}(?:/[A-Z]{3,4}\d{3})+")
-single_unit_pattern = re.compile(r"[A-Z]{3,4}\d{3}")
-stream_pattern = re.compile(r"Stream\s*(\d+)", re.IGNORECASE)
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def detect_campus(name: str) -> str:
-    name = str(name).upper()
-    if " WA " in name:
-        return "WA"
-    elif " TAS " in name:
-        return "TAS"
-    return "SYD"
+def excel_engine():
+    # calamine (Rust) parses xlsx several times faster than openpyxl
+    if importlib.util.find_spec("python_calamine") is not None:
+        return "calamine"
+    return None
 
 
-def detect_stream(name: str) -> str:
-    match = stream_pattern.search(name)
-    return f"Stream{match.group(1)}" if match else "Stream1"
+def sidecar_format():
+    if importlib.util.find_spec("pyarrow") is not None:
+        return "parquet"
+    return "pickle"
 
 
-def extract_codes(text: str):
-    if not isinstance(text, str):
-        return []
-    match = combine_unit_pattern.search(text)
-    if match:
-        return match.group(0).split("/")
-    match = single_unit_pattern.search(text)
-    return [match.group(0)] if match else []
+def load_sheet(path, columns, cache_dir=None):
+    """Read `columns` of an xlsx, via a sidecar keyed by the file's hash.
 
+    The first read of a given file parses the workbook and writes
+    <cache_dir>/sheets/<sha256>-<columns>.<fmt>; later reads of the
+    unchanged file load the sidecar instead.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    fmt = sidecar_format()
+    col_key = hashlib.sha1("\0".join(columns).encode()).hexdigest()[:8]
+    sidecar = os.path.join(cache_dir, "sheets", f"{file_sha256(path)}-{col_key}.{fmt}")
 
-def get_campuses(key: str, text: str):
-    match = re.search(r"\((SYD|WA|TAS)(?:/(SYD|WA|TAS))*\)", str(text))
-    if match:
-        campuses = re.findall(r"(SYD|WA|TAS)", match.group(0))
-        return sorted(set(campuses))
-    elif "WA" in str(key):
-        return ["WA"]
-    elif "TAS" in str(key):
-        return ["TAS"]
-    else:
-        return ["SYD"]
+    if os.path.exists(sidecar):
+        try:
+            if fmt == "parquet":
+                return pd.read_parquet(sidecar)
+            return pd.read_pickle(sidecar)
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable sidecar {sidecar}: {e}")
 
+    df = pd.read_excel(path, usecols=columns, engine=excel_engine())
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        # several batch workers may parse the same unit file at once
+        tmp = f"{sidecar}.{os.getpid()}.tmp"
+        if fmt == "parquet":
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, sidecar)
+    except Exception as e:
+        print(f"⚠️ Could not write sidecar for {path}: {e}")
+    return df
 
-def get_stream(desc: str):
-    if "Class 1" in str(desc):
-        return "Stream1"
-    elif "Class 2" in str(desc):
-        return "Stream2"
-    else:
-        return "Stream1"
+
+
+def sheet_header(path):
+    """Column names of a .csv or .xlsx export, without reading its rows."""
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path, nrows=0).columns.tolist()
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        return list(next(workbook.active.iter_rows(values_only=True), ()))
+    finally:
+        workbook.close()
+
+
+def iter_sheet_chunks(path, columns, chunk_rows=STREAM_CHUNK_ROWS):
+    """Yield `columns` of a .csv or .xlsx export as DataFrames of chunk_rows rows.
+
+    xlsx is walked with openpyxl's read-only row iterator, so the workbook
+    is never materialised as a whole.
+    """
+    if path.lower().endswith(".csv"):
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows)
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, ())
+        positions = [header.index(c) for c in columns]
+        buffer = []
+        for row in rows:
+            buffer.append([row[i] if i < len(row) else None for i in positions])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
 
 
 # =========================================================
-# ④ build data structures
+# ④ campus / stream / unit-code classifier
 # =========================================================
-def build_campus_tree(df):
-    campus_tree = {
-        "WA": {"Stream1": [], "Stream2": []},
-        "TAS": {"Stream1": [], "Stream2": []},
-        "SYD": {"Stream1": [], "Stream2": []},
-    }
+# every (possibly overlapping) unit-code-shaped substring, used by the code index
+code_window_pattern = re.compile(r"(?=([A-Z]{3,4}\d{3}))")
+# numeric username on the student domain: the only accounts we ever unenrol
+student_email_pattern = re.compile(r"\d+@student\.imc\.edu\.au", re.IGNORECASE)
+
+CLASSIFIER_RULES_PATH = os.getenv("CLASSIFIER_RULES")
+
+# campuses are listed in priority order: when a TimetableID carries several
+# campus tokens, or a shortname contains several campus names, the first wins
+DEFAULT_CLASSIFIER_RULES = {
+    "campuses": ["WA", "TAS", "SYD"],
+    "default_campus": "SYD",
+    "timetable_stream_word": "Stream",
+    "unit_stream_word": "Class",
+    "default_stream": "Stream1",
+    "exclude_timetable_words": ["Tutorial"],
+}
 
-    filtered_df = df[~df["TimetableID"].str.contains("Tutorial", case=False, na=False)]
-    unique_courses = filtered_df["TimetableID"].dropna().unique()
 
-    for course in unique_courses:
-        campus = detect_campus(course)
-        stream = detect_stream(course)
-        campus_tree[campus][stream].append(course)
+class Classifier:
+    """Rule table compiled into one matcher per column kind.
 
-    return campus_tree
+    TimetableIDs: space-delimited campus tokens (any case), "Stream N" and
+    excluded words, found in a single finditer pass.
+    Unit fullnames: "(SYD/WA)" campus lists, "Class N" and unit codes (a
+    combined "ACC101/ACC102" run wins over a single code), also in one pass.
+    """
+
+    def __init__(self, rules=None):
+        rules = {**DEFAULT_CLASSIFIER_RULES, **(rules or {})}
+        self.campuses = list(rules["campuses"])
+        self.default_campus = rules["default_campus"]
+        self.default_stream = rules["default_stream"]
+        self.rank = {c.upper(): i for i, c in enumerate(self.campuses)}
+        self.fallback_campuses = [c for c in self.campuses if c != self.default_campus]
+
+        alt = "|".join(re.escape(c) for c in self.campuses)
+        exclude = "|".join(re.escape(w) for w in rules["exclude_timetable_words"]) or "(?!)"
+        self.campus_name_pattern = re.compile(alt)
+        self.timetable_matcher = re.compile(
+            rf"(?P<campus>(?<= )(?:{alt})(?= ))"
+            rf"|{re.escape(rules['timetable_stream_word'])}\s*(?P<stream>\d+)"
+            rf"|(?P<exclude>{exclude})",
+            re.IGNORECASE,
+        )
+        self.unit_matcher = re.compile(
+            rf"(?P<campuses>\((?:{alt})(?:/(?:{alt}))*\))"
+            rf"|{re.escape(rules['unit_stream_word'])} (?P<stream>\d+)"
+            r"|(?P<codes>[A-Z]{3,4}\d{3}(?:/[A-Z]{3,4}\d{3})*)"
+        )
+
+    def classify_timetable_id(self, text):
+        """(campus, stream, excluded) for one TimetableID."""
+        best, stream, excluded = None, None, False
+        for m in self.timetable_matcher.finditer(text):
+            if m.group("campus"):
+                rank = self.rank[m.group("campus").upper()]
+                best = rank if best is None else min(best, rank)
+            elif m.group("stream"):
+                if stream is None:
+                    stream = f"Stream{m.group('stream')}"
+            else:
+                excluded = True
+        campus = self.campuses[best] if best is not None else self.default_campus
+        return campus, stream or self.default_stream, excluded
+
+    def classify_unit(self, shortname, fullname):
+        """(codes, campuses, stream) for one Unit Creation row."""
+        combined, single, campuses, stream = None, None, None, None
+        for m in self.unit_matcher.finditer(str(fullname)):
+            if m.group("campuses"):
+                if campuses is None:
+                    campuses = sorted(set(self.campus_name_pattern.findall(m.group("campuses"))))
+            elif m.group("stream"):
+                if stream is None:
+                    stream = f"Stream{m.group('stream')}"
+            elif "/" in m.group("codes"):
+                if combined is None:
+                    combined = m.group("codes").split("/")
+            elif single is None:
+                single = [m.group("codes")]
+        if campuses is None:
+            campuses = next(
+                ([c] for c in self.fallback_campuses if c in str(shortname)), [self.default_campus]
+            )
+        codes = combined or single or []
+        return codes, campuses, stream or self.default_stream
+
+    def classify_timetable_column(self, series):
+        """DataFrame(campus, stream, excluded) aligned with `series`, one pass per unique ID."""
+        codes, uniques = pd.factorize(series)
+        # missing IDs (code -1) land on a trailing excluded row
+        table = pd.DataFrame(
+            [self.classify_timetable_id(str(t)) for t in uniques] + [(None, None, True)],
+            columns=["campus", "stream", "excluded"],
+        )
+        return table.iloc[codes].set_axis(series.index)
+
+    def classify_units(self, module_dict):
+        """shortname -> (codes, campuses, stream) for every module."""
+        return {s: self.classify_unit(s, f) for s, f in module_dict.items()}
+
+
+def load_classifier(path=CLASSIFIER_RULES_PATH):
+    if not path:
+        return Classifier()
+    with open(path, encoding="utf-8") as f:
+        return Classifier(json.load(f))
+
+
+CLASSIFIER = load_classifier()
+
+
+# =========================================================
+# ⑤ build data structures
+# =========================================================
+def build_campus_tree(df, classifier=None):
+    """campus -> stream -> [TimetableID], for whatever campuses/streams occur."""
+    classifier = classifier or CLASSIFIER
+    unique_courses = pd.Series(df["TimetableID"].dropna().unique())
+    classes = classifier.classify_timetable_column(unique_courses)
+
+    campus_tree = {}
+    for course, campus, stream, excluded in zip(
+        unique_courses, classes["campus"], classes["stream"], classes["excluded"]
+    ):
+        if not excluded:
+            campus_tree.setdefault(campus, {}).setdefault(stream, []).append(course)
+
+    code_index = build_code_index(campus_tree)
+    return campus_tree, code_index
+
+
+def build_code_index(campus_tree):
+    """Map every unit-code-shaped substring to {(campus, stream): [positions]}.
+
+    `code in course_name` holds exactly when `code` is one of the windows
+    indexed for `course_name`, so lookups keep the substring semantics of
+    the old scan (e.g. ACC101 still hits "ACC101/ACC102 ...").
+    """
+    code_index = {}
+    for campus, streams in campus_tree.items():
+        for stream, courses in streams.items():
+            for pos, course_name in enumerate(courses):
+                windows = {m.group(1) for m in code_window_pattern.finditer(str(course_name))}
+                for window in windows:
+                    code_index.setdefault(window, {}).setdefault(
+                        (campus, stream), []
+                    ).append(pos)
+    return code_index
 
 
 def build_module_dict(df):
-    mapping = {}
-    for _, row in df.iterrows():
-        shortname = row.get("shortname")
-        fullname = row.get("fullname")
-        if pd.notna(shortname) and pd.notna(fullname):
-            mapping[shortname.strip()] = fullname.strip()
-    return mapping
+    pairs = df[["shortname", "fullname"]].dropna()
+    if pairs.empty:
+        return {}
+    return dict(zip(pairs["shortname"].str.strip(), pairs["fullname"].str.strip()))
+
 
+def generate_mapping(campus_tree, module_dict, code_index=None, classifier=None, units=None):
+    """units: classify_units(module_dict), for callers that map many batches against one unit file."""
+    if code_index is None:
+        code_index = build_code_index(campus_tree)
+    if units is None:
+        units = (classifier or CLASSIFIER).classify_units(module_dict)
 
-def generate_mapping(campus_tree, module_dict):
     result = []
-    for short_name, full_name in module_dict.items():
-        codes = extract_codes(full_name)
+    for short_name, (codes, campuses, stream) in units.items():
         if not codes:
             continue
-        campuses = get_campuses(short_name, full_name)
-        stream = get_stream(full_name)
         for campus in campuses:
             if campus not in campus_tree or stream not in campus_tree[campus]:
                 continue
-            for course_name in campus_tree[campus][stream]:
-                if any(code in course_name for code in codes):
-                    result.append(
-                        {"timetable_id": course_name, "short_name": short_name}
-                    )
+            positions = set()
+            for code in codes:
+                positions.update(code_index.get(code, {}).get((campus, stream), ()))
+            courses = campus_tree[campus][stream]
+            for pos in sorted(positions):
+                result.append({"timetable_id": courses[pos], "short_name": short_name})
     return result
 
 
 # =========================================================
-# ⑤ Moodle API function
+# ⑥ Moodle API client
 # =========================================================
-def moodle_api(wsfunction, params):
-    params.update(
-        {
-            "wstoken": MOODLE_TOKEN,
-            "wsfunction": wsfunction,
-            "moodlewsrestformat": "json",
-        }
+# sent as POST so large enrolment batches don't hit URL length limits
+WRITE_FUNCTIONS = {"enrol_manual_enrol_users", "enrol_manual_unenrol_users"}
+# safe to resend: reads, and manual (un)enrolment, which Moodle treats as a no-op
+# when the user is already (un)enrolled
+IDEMPOTENT_FUNCTIONS = {
+    "core_course_get_courses_by_field",
+    "core_enrol_get_enrolled_users",
+    "core_user_get_users_by_field",
+    "enrol_manual_enrol_users",
+    "enrol_manual_unenrol_users",
+}
+# Moodle exception payloads that signal an overloaded site rather than a bad request
+TRANSIENT_MOODLE_ERRORS = {"dmlreadexception", "dmlwriteexception", "dbtransientexception"}
+# ones that can blame a single record of an enrolment batch, so bisecting finds it
+RECORD_MOODLE_ERRORS = {"invalidparameter", "invalidrecord", "wsnoinstance", "wscannotenrol", "wscannotunenrol"}
+# the token or service itself is refused: every further call would fail the same way
+FATAL_MOODLE_ERRORS = {
+    "invalidtoken",
+    "accessexception",
+    "nopermissions",
+    "servicerequireslogin",
+    "requireloginerror",
+    "webservicesnotenabled",
+}
+
+
+class MoodleError(Exception):
+    """Moodle answered HTTP 200 with an exception payload."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.errorcode = payload.get("errorcode")
+        super().__init__(f"{payload.get('exception')}: {payload.get('message')}")
+
+
+class RateController:
+    """AIMD request pacing shared by every thread of a client.
+
+    Until the first overload signal the rate grows by one request/second
+    per success (slow start, roughly doubling every second); after that,
+    healthy responses raise it by `increase` requests/second per second.
+    Overload signals halve it (at most once per `cooldown`) and pause new
+    requests for a jittered backoff.
+    """
+
+    def __init__(
+        self, rate=MOODLE_RATE, max_rate=MOODLE_RATE_MAX, min_rate=0.5, increase=5.0, cooldown=1.0
+    ):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+        self._last_decrease = 0.0
+        self._slow_start = True
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self):
+        with self._lock:
+            step = 1.0 if self._slow_start else self.increase / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def on_overload(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self._slow_start = False
+            if now - self._last_decrease >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._last_decrease = now
+            pause = retry_after if retry_after else random.uniform(0.5, 1.5) / self.rate
+            self._next_slot = max(self._next_slot, now + pause)
+
+
+def retry_delay(attempt, retry_after=None, base=0.5, cap=30.0):
+    # exponential backoff with full jitter, unless the server said when to come back
+    if retry_after:
+        return retry_after
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def classify_error(error):
+    """(transient, retry_after seconds or None) for a failed call."""
+    if isinstance(error, MoodleError):
+        return error.errorcode in TRANSIENT_MOODLE_ERRORS, None
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True, None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        if status == 429 or status >= 500:
+            retry_after = error.response.headers.get("Retry-After")
+            try:
+                return True, float(retry_after) if retry_after else None
+            except ValueError:
+                return True, None
+    return False, None
+
+
+def is_fatal_error(error):
+    """Auth or permission failure: no further call with these credentials can succeed."""
+    if isinstance(error, MoodleError):
+        return error.errorcode in FATAL_MOODLE_ERRORS
+    return (
+        isinstance(error, requests.HTTPError)
+        and error.response is not None
+        and error.response.status_code in (401, 403)
     )
-    response = requests.get(MOODLE_URL, params=params, timeout=60)
-    response.raise_for_status()
-    data = response.json()
-    return data
+
+
+class ApiStats:
+    """Per-wsfunction call counts, latency histogram, response bytes, retries, errors."""
+
+    # upper bounds in seconds, Prometheus-style cumulative buckets plus +Inf
+    BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.functions = {}
+
+    def _entry(self, wsfunction):
+        entry = self.functions.get(wsfunction)
+        if entry is None:
+            entry = self.functions[wsfunction] = {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "response_bytes": 0,
+                "latency_sum": 0.0,
+                "latency_max": 0.0,
+                "buckets": [0] * (len(self.BUCKETS) + 1),
+            }
+        return entry
+
+    def record(self, wsfunction, latency, response_bytes=0, error=False):
+        with self._lock:
+            entry = self._entry(wsfunction)
+            entry["calls"] += 1
+            entry["errors"] += int(error)
+            entry["response_bytes"] += response_bytes
+            entry["latency_sum"] += latency
+            entry["latency_max"] = max(entry["latency_max"], latency)
+            entry["buckets"][bisect.bisect_left(self.BUCKETS, latency)] += 1
+
+    def record_retry(self, wsfunction):
+        with self._lock:
+            self._entry(wsfunction)["retries"] += 1
+
+    def merge(self, functions):
+        """Add another ApiStats' .functions (e.g. from a worker process) into this one."""
+        with self._lock:
+            for wsfunction, other in functions.items():
+                entry = self._entry(wsfunction)
+                for key in ("calls", "errors", "retries", "response_bytes", "latency_sum"):
+                    entry[key] += other[key]
+                entry["latency_max"] = max(entry["latency_max"], other["latency_max"])
+                entry["buckets"] = [a + b for a, b in zip(entry["buckets"], other["buckets"])]
+
+    def _quantile(self, buckets, q):
+        # upper bound of the bucket holding the q-th call
+        rank = q * sum(buckets)
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (float("inf"),), buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def summary(self):
+        with self._lock:
+            out = {}
+            for wsfunction, e in sorted(self.functions.items()):
+                out[wsfunction] = {
+                    "calls": e["calls"],
+                    "errors": e["errors"],
+                    "retries": e["retries"],
+                    "response_bytes": e["response_bytes"],
+                    "latency_mean_s": round(e["latency_sum"] / e["calls"], 4) if e["calls"] else 0.0,
+                    "latency_max_s": round(e["latency_max"], 4),
+                    "latency_p50_le_s": self._quantile(e["buckets"], 0.5),
+                    "latency_p90_le_s": self._quantile(e["buckets"], 0.9),
+                    "latency_p99_le_s": self._quantile(e["buckets"], 0.99),
+                    "latency_buckets": dict(
+                        zip([str(b) for b in self.BUCKETS] + ["+Inf"], e["buckets"])
+                    ),
+                }
+            return out
+
+    def write_json(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        lines = [
+            "# TYPE moodle_api_calls_total counter",
+            "# TYPE moodle_api_errors_total counter",
+            "# TYPE moodle_api_retries_total counter",
+            "# TYPE moodle_api_response_bytes_total counter",
+            "# TYPE moodle_api_latency_seconds histogram",
+        ]
+        with self._lock:
+            for wsfunction, e in sorted(self.functions.items()):
+                label = f'wsfunction="{wsfunction}"'
+                lines.append(f"moodle_api_calls_total{{{label}}} {e['calls']}")
+                lines.append(f"moodle_api_errors_total{{{label}}} {e['errors']}")
+                lines.append(f"moodle_api_retries_total{{{label}}} {e['retries']}")
+                lines.append(f"moodle_api_response_bytes_total{{{label}}} {e['response_bytes']}")
+                cumulative = 0
+                for bound, count in zip([str(b) for b in self.BUCKETS] + ["+Inf"], e["buckets"]):
+                    cumulative += count
+                    lines.append(
+                        f'moodle_api_latency_seconds_bucket{{{label},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"moodle_api_latency_seconds_sum{{{label}}} {e['latency_sum']:.6f}")
+                lines.append(f"moodle_api_latency_seconds_count{{{label}}} {e['calls']}")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def print_table(self):
+        summary = self.summary()
+        if not summary:
+            return
+        print(f"\n📈 {'wsfunction':<36}{'calls':>7}{'errors':>8}{'retries':>9}{'MB':>9}{'mean s':>9}{'p90 ≤ s':>9}")
+        for wsfunction, e in summary.items():
+            print(
+                f"   {wsfunction:<36}{e['calls']:>7}{e['errors']:>8}{e['retries']:>9}"
+                f"{e['response_bytes'] / 2**20:>9.2f}{e['latency_mean_s']:>9.3f}{e['latency_p90_le_s']:>9}"
+            )
+
+    def report(self, json_path, prom_path=None):
+        """Print the table and write the JSON summary, plus Prometheus metrics if asked."""
+        self.print_table()
+        self.write_json(json_path)
+        if prom_path:
+            self.write_prometheus(prom_path)
+
+
+class MoodleClient:
+    """Keep-alive session pool with a bounded number of in-flight requests."""
+
+    def __init__(
+        self,
+        url,
+        token,
+        concurrency=MOODLE_CONCURRENCY,
+        timeout=60,
+        stats=None,
+        rate=None,
+        max_retries=MOODLE_MAX_RETRIES,
+    ):
+        self.url = url
+        self.token = token
+        self.stats = stats if stats is not None else ApiStats()
+        self.rate = rate if rate is not None else RateController()
+        self.max_retries = max_retries
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.concurrency
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def call(self, wsfunction, params):
+        """One API call, paced by the rate controller.
+
+        Idempotent calls are retried on transient failures (HTTP 429/5xx,
+        timeouts, connection errors, transient Moodle exceptions).
+        """
+        attempts = 1 + (self.max_retries if wsfunction in IDEMPOTENT_FUNCTIONS else 0)
+        for attempt in range(attempts):
+            try:
+                data = self._send(wsfunction, params)
+            except Exception as e:
+                transient, retry_after = classify_error(e)
+                if transient:
+                    self.rate.on_overload(retry_after)
+                if not transient or attempt == attempts - 1:
+                    raise
+                self.stats.record_retry(wsfunction)
+                time.sleep(retry_delay(attempt, retry_after))
+                continue
+            self.rate.on_success()
+            return data
+
+    def _send(self, wsfunction, params):
+        params = dict(params)
+        params.update(
+            {
+                "wstoken": self.token,
+                "wsfunction": wsfunction,
+                "moodlewsrestformat": "json",
+            }
+        )
+        with self._slots:
+            self.rate.acquire()
+            started = time.perf_counter()
+            try:
+                if wsfunction in WRITE_FUNCTIONS:
+                    response = self.session.post(self.url, data=params, timeout=self.timeout)
+                else:
+                    response = self.session.get(self.url, params=params, timeout=self.timeout)
+            except Exception:
+                self.stats.record(wsfunction, time.perf_counter() - started, error=True)
+                raise
+            latency = time.perf_counter() - started
+        try:
+            response.raise_for_status()
+            data = response.json()
+            if isinstance(data, dict) and "exception" in data:
+                raise MoodleError(data)
+        except Exception:
+            self.stats.record(wsfunction, latency, len(response.content), error=True)
+            raise
+        self.stats.record(wsfunction, latency, len(response.content))
+        return data
+
+    def imap(self, wsfunction, params_list, desc=None):
+        """Run one call per params dict concurrently.
+
+        Yields (idx, data, error) as calls complete; exactly one of
+        data/error is set for each entry.
+        """
+        futures = {
+            self._executor.submit(self.call, wsfunction, params): idx
+            for idx, params in enumerate(params_list)
+        }
+        try:
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc=desc, disable=desc is None
+            ):
+                idx = futures.pop(future)
+                try:
+                    yield idx, future.result(), None
+                except Exception as e:
+                    yield idx, None, e
+        finally:
+            # a caller that stops early doesn't send the calls that haven't started
+            for future in futures:
+                future.cancel()
+
+    def map(self, wsfunction, params_list, desc=None):
+        """Like imap, but returns (params, data, error) tuples in input order."""
+        params_list = list(params_list)
+        results = [None] * len(params_list)
+        for idx, data, error in self.imap(wsfunction, params_list, desc):
+            results[idx] = (params_list[idx], data, error)
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+
+_default_client = None
+
+
+def get_client():
+    global _default_client
+    if _default_client is None:
+        _default_client = MoodleClient(MOODLE_URL, MOODLE_TOKEN)
+    return _default_client
+
+
+def moodle_api(wsfunction, params):
+    return get_client().call(wsfunction, params)
 
 
 # =========================================================
-# ⑥ Main Process
+# ⑦ persistent ID cache
 # =========================================================
-if __name__ == "__main__":
-    df_current = pd.read_excel(file_path_current_enrolled_modules)
-    df_unit = pd.read_excel(file_path_unit_creation)
+class IdCache:
+    """SQLite key -> Moodle ID store with per-entry TTL and LRU eviction.
 
-    campus_tree = build_campus_tree(df_current)
-    module_dict = build_module_dict(df_unit)
-    result = generate_mapping(campus_tree, module_dict)
+    kind is "course" (keyed by shortname) or "user" (keyed by canonical
+    email). With refresh=True reads always miss, so every key is fetched
+    again and the fresh value overwrites the stored one.
+    """
 
-    result_df = pd.DataFrame(result).rename(columns={"timetable_id": "TimetableID"})
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, refresh=False):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ids ("
+            " kind TEXT NOT NULL, key TEXT NOT NULL, value INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (kind, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ids_last_used ON ids (last_used)")
+        self.conn.commit()
 
-    merged_df = pd.merge(df_current, result_df, on="TimetableID", how="inner")
-    final_df = merged_df[["Email2", "short_name"]].rename(columns={"Email2": "email"})
+    def get_many(self, kind, keys):
+        if self.refresh:
+            return {}
+        now = time.time()
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, value FROM ids WHERE kind = ? AND key IN ({marks}) AND expires_at > ?",
+                [kind, *chunk, now],
+            )
+            found.update(rows)
+        if found:
+            self.conn.executemany(
+                "UPDATE ids SET last_used = ? WHERE kind = ? AND key = ?",
+                [(now, kind, key) for key in found],
+            )
+            self.conn.commit()
+        return found
 
-    # =========================================================
-    # Step 1. get course_id
-    # =========================================================
-    course_map = {}
-    unit_shortnames = df_unit["shortname"].dropna().unique().tolist()
+    def put_many(self, kind, mapping, ttl):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ids (kind, key, value, expires_at, last_used) VALUES (?, ?, ?, ?, ?)",
+            [(kind, key, value, now + ttl, now) for key, value in mapping.items()],
+        )
+        self._evict(now)
+        self.conn.commit()
 
-    for shortname in tqdm(unit_shortnames, desc="Fetching course IDs"):
-        try:
-            result = moodle_api(
-                "core_course_get_courses_by_field",
-                {"field": "shortname", "value": shortname},
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM ids WHERE expires_at <= ?", (now,))
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM ids").fetchone()
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM ids WHERE rowid IN (SELECT rowid FROM ids ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
             )
-            courses = result.get("courses", [])
-            if courses:
-                course_map[shortname] = courses[0]["id"]
+
+    def close(self):
+        self.conn.close()
+
+
+# =========================================================
+# ⑧ Moodle stages
+# =========================================================
+def fetch_course_ids(client, shortnames, cache=None):
+    """Resolve shortnames against one catalogue fetch, per-shortname for misses."""
+    course_map = cache.get_many("course", shortnames) if cache else {}
+    uncached = [s for s in shortnames if s not in course_map]
+    if cache:
+        print(f"🗄️ {len(course_map)} course IDs from cache, {len(uncached)} to fetch")
+
+    if uncached:
+        fetched = {}
+        catalogue = fetch_course_catalogue(client)
+        misses = []
+        for shortname in uncached:
+            if shortname in catalogue:
+                fetched[shortname] = catalogue[shortname]
             else:
-                print(f"Don't find course: {shortname}")
-            time.sleep(0.2)
-        except Exception as e:
-            print(f"❌ Get {shortname} failed: {e}")
+                misses.append(shortname)
+        if catalogue:
+            print(f"📚 Catalogue has {len(catalogue)} courses, {len(misses)} shortnames to look up")
+
+        fetched.update(fetch_course_ids_by_shortname(client, misses))
+        if cache:
+            cache.put_many("course", fetched, COURSE_CACHE_TTL)
+        course_map.update(fetched)
+    # keep course_map in the order of the Unit Creation sheet
+    return {s: course_map[s] for s in shortnames if s in course_map}
+
+
+def fetch_course_catalogue(client):
+    """shortname -> id for every course, from a single field-less call."""
+    try:
+        result = client.call("core_course_get_courses_by_field", {})
+    except Exception as e:
+        print(f"⚠️ Course catalogue fetch failed, falling back to per-shortname lookups: {e}")
+        return {}
+    return {c["shortname"]: c["id"] for c in result.get("courses", []) if "shortname" in c}
+
+
+def fetch_course_ids_by_shortname(client, shortnames):
+    course_map = {}
+    params_list = [{"field": "shortname", "value": s} for s in shortnames]
+    for params, result, error in client.map(
+        "core_course_get_courses_by_field", params_list, desc="Fetching course IDs"
+    ):
+        shortname = params["value"]
+        if error is not None:
+            print(f"❌ Get {shortname} failed: {error}")
             continue
+        courses = result.get("courses", [])
+        if courses:
+            course_map[shortname] = courses[0]["id"]
+        else:
+            print(f"Don't find course: {shortname}")
+    return course_map
 
-    print(f"✅ Successfully get {len(course_map)} unit ID")
 
-    # =========================================================
-    # Step 2. get enrolled users
-    # =========================================================
-    enrolled_data = {}
-    for short_name, course_id in tqdm(course_map.items(), desc="Fetching enrolled users"):
-        try:
-            users = moodle_api("core_enrol_get_enrolled_users", {"courseid": course_id})
-            enrolled_data[course_id] = {u["email"] for u in users if "email" in u}
-        except Exception as e:
-            print(f"❌ get course {short_name} student failed: {e}")
+def enrolled_users_params(course_id, limitfrom, page_size, field="email"):
+    return {
+        "courseid": course_id,
+        "options[0][name]": "userfields",
+        "options[0][value]": field,
+        "options[1][name]": "limitfrom",
+        "options[1][value]": limitfrom,
+        "options[2][name]": "limitnumber",
+        "options[2][value]": page_size,
+    }
+
+
+def fetch_enrolled_emails(client, course_map, page_size=ENROLLED_PAGE_SIZE, field="email"):
+    """course_id -> set of enrolled emails, paged and projected to email only.
+
+    Every course's next page is requested in the same round, and each page
+    is folded into its course's set as soon as it arrives. field="id"
+    collects user IDs instead.
+    """
+    enrolled_data = {course_id: set() for course_id in course_map.values()}
+    names = {course_id: short_name for short_name, course_id in course_map.items()}
+    pending = [(course_id, 0) for course_id in enrolled_data]
+    page = 1
+    while pending:
+        params_list = [enrolled_users_params(c, start, page_size, field) for c, start in pending]
+        next_round = []
+        for idx, users, error in client.imap(
+            "core_enrol_get_enrolled_users", params_list,
+            desc=f"Fetching enrolled users (page {page})",
+        ):
+            course_id, start = pending[idx]
+            if error is not None:
+                print(f"❌ get course {names[course_id]} student failed: {error}")
+                enrolled_data.pop(course_id, None)
+                continue
+            if course_id not in enrolled_data:
+                continue
+            enrolled_data[course_id].update(u[field] for u in users if field in u)
+            if len(users) >= page_size:
+                next_round.append((course_id, start + page_size))
+        pending = next_round
+        page += 1
+    return enrolled_data
+
+
+# accepted headers of a Moodle enrolment export, matched case-insensitively.
+# From the database, an equivalent CSV is e.g.
+#   SELECT c.id AS courseid, c.shortname, u.id AS userid, u.email
+#   FROM mdl_user_enrolments ue JOIN mdl_enrol e ON e.id = ue.enrolid
+#   JOIN mdl_course c ON c.id = e.courseid JOIN mdl_user u ON u.id = ue.userid
+EXPORT_COURSE_ID_COLUMNS = ("courseid", "course_id", "course id")
+EXPORT_SHORTNAME_COLUMNS = ("shortname", "course shortname", "course_shortname", "course")
+EXPORT_EMAIL_COLUMNS = ("email", "email address", "useremail", "user_email")
+EXPORT_USER_ID_COLUMNS = ("userid", "user_id", "user id")
+
+
+def export_column(header, candidates):
+    lowered = {str(h).strip().lower(): h for h in header if h is not None}
+    return next((lowered[c] for c in candidates if c in lowered), None)
+
+
+def load_enrolled_emails(path, course_map, chunk_rows=STREAM_CHUNK_ROWS):
+    """fetch_enrolled_emails from a bulk enrolment export instead of the API.
+
+    Returns (enrolled_data, user_ids). enrolled_data has the same shape as
+    fetch_enrolled_emails, with every course in course_map present. The
+    export is streamed in chunks and only rows of those courses are kept.
+    Courses are identified by an ID column if there is one, else by
+    shortname. If the export has a user ID column, user_ids maps the
+    canonical email to that ID; otherwise it is empty.
+    """
+    header = sheet_header(path)
+    email_col = export_column(header, EXPORT_EMAIL_COLUMNS)
+    id_col = export_column(header, EXPORT_COURSE_ID_COLUMNS)
+    course_col = id_col or export_column(header, EXPORT_SHORTNAME_COLUMNS)
+    user_col = export_column(header, EXPORT_USER_ID_COLUMNS)
+    if email_col is None or course_col is None:
+        raise ValueError(f"{path} needs an email column and a course id or shortname column, got {header}")
+
+    enrolled_data = {course_id: set() for course_id in course_map.values()}
+    wanted = set(enrolled_data)
+    user_ids = {}
+    columns = [course_col, email_col] + ([user_col] if user_col else [])
+    for chunk in tqdm(iter_sheet_chunks(path, columns, chunk_rows), desc="Reading enrolment export"):
+        if id_col:
+            course_ids = pd.to_numeric(chunk[course_col], errors="coerce")
+        else:
+            course_ids = chunk[course_col].map(course_map)
+        keep = course_ids.isin(wanted) & chunk[email_col].notna()
+        if not keep.any():
             continue
+        emails = chunk[email_col][keep].astype(str)
+        grouped = emails.groupby(course_ids[keep].astype("int64").to_numpy(), sort=False).agg(set)
+        for course_id, members in grouped.items():
+            enrolled_data[course_id].update(members)
+        if user_col:
+            ids = pd.to_numeric(chunk[user_col][keep], errors="coerce")
+            known = ids.notna()
+            user_ids.update(zip(map(canonical_email, emails[known]), ids[known].astype("int64").tolist()))
+    return enrolled_data, user_ids
+
+
+def fetch_user_ids_bulk(client, emails, batch_size=50, cache=None):
+    """Batch get user IDs via core_user_get_users_by_field, keyed by canonical email"""
+    # Moodle API can handle around 50 safely per call
+    user_map = {}
+    # one lookup per person, however many spellings/records they have
+    requested = len(emails)
+    emails = list(dict.fromkeys(canonical_email(e) for e in emails))
+    if len(emails) < requested:
+        print(f"🧹 {requested - len(emails)} duplicate emails dropped before lookup")
+    if cache:
+        cached = cache.get_many("user", emails)
+        emails = [e for e in emails if e not in cached]
+        print(f"🗄️ {len(cached)} user IDs from cache, {len(emails)} to fetch")
+    batches = [emails[i:i + batch_size] for i in range(0, len(emails), batch_size)]
+    params_list = []
+    for batch in batches:
+        params = {"field": "email"}
+        for idx, email in enumerate(batch):
+            params[f"values[{idx}]"] = email
+        params_list.append(params)
+
+    responses = client.map(
+        "core_user_get_users_by_field", params_list, desc="Fetching user IDs"
+    )
+    for batch, (_, data, error) in zip(batches, responses):
+        if error is not None:
+            print(f"❌ Failed fetching batch starting {batch[0]}: {error}")
+            continue
+        if isinstance(data, list):
+            for user in data:
+                if "email" in user and "id" in user:
+                    user_map[canonical_email(user["email"])] = user["id"]
+    if cache:
+        cache.put_many("user", user_map, USER_CACHE_TTL)
+        user_map.update(cached)
+    return user_map
+
+
+def enrolment_params(items, role_id=None):
+    params = {}
+    for idx, item in enumerate(items):
+        if role_id is not None:
+            params[f"enrolments[{idx}][roleid]"] = role_id
+        params[f"enrolments[{idx}][userid]"] = item["userid"]
+        params[f"enrolments[{idx}][courseid]"] = item["course_id"]
+    return params
 
-    # =========================================================
-    # Step 3. construct target enrolment data
-    # =========================================================
-    final_df = final_df[final_df["short_name"].isin(course_map.keys())]
-    final_df["course_id"] = final_df["short_name"].map(course_map)
 
+def run_enrolment_batches(
+    client, wsfunction, items, batch_size=ENROL_BATCH_SIZE, role_id=None, on_outcomes=None
+):
+    """Send enrolments in batches of batch_size; bisect batches Moodle rejects a record of.
+
+    Returns (item, error) for every item, error being None on success, so a
+    bad record only costs its own outcome instead of its whole batch. Only
+    a RECORD_MOODLE_ERRORS exception can point at a record; any other
+    error (a transient one that outlasted the client's retries included)
+    settles the whole batch as failed, to be replayed with --resume. A
+    fatal (auth/permission) error stops sending: every item not yet sent
+    is settled with it.
+    on_outcomes, if given, is called with each settled slice of outcomes as
+    soon as its batch completes.
+    """
+    outcomes = []
+
+    def settle(settled):
+        outcomes.extend(settled)
+        if on_outcomes is not None:
+            on_outcomes(settled)
+
+    pending = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    while pending:
+        retry, unsent = [], set(range(len(pending)))
+        results = client.imap(
+            wsfunction,
+            [enrolment_params(batch, role_id) for batch in pending],
+            desc=f"{wsfunction} ({sum(map(len, pending))} records)",
+        )
+        for idx, _, error in results:
+            batch = pending[idx]
+            unsent.discard(idx)
+            if error is None:
+                settle([(item, None) for item in batch])
+            elif len(batch) > 1 and isinstance(error, MoodleError) and error.errorcode in RECORD_MOODLE_ERRORS:
+                mid = len(batch) // 2
+                retry.extend([batch[:mid], batch[mid:]])
+            else:
+                settle([(item, error) for item in batch])
+                if is_fatal_error(error):
+                    results.close()
+                    left = [pending[i] for i in sorted(unsent)] + retry
+                    settle([(item, error) for batch in left for item in batch])
+                    return outcomes
+        pending = retry
+    return outcomes
+
+
+def resolve_user_ids(records, user_cache):
+    items = []
+    for record in records:
+        email = canonical_email(record["email"])
+        userid = user_cache.get(email)
+        if not userid:
+            print(f"⚠️ Skip: user not found for {email}")
+            continue
+        items.append({**record, "userid": userid})
+    return items
+
+
+def describe_item(item):
+    # plan-replayed items only carry IDs
+    return f"{item.get('email', 'user ' + str(item['userid']))} -> {item.get('shortname', item['course_id'])}"
+
+
+def apply_changes(client, enrol_items, unenrol_items, journal=None):
+    # ----------------------------
+    # Enrol users
+    # ----------------------------
+    print("\n🚀 Starting enrol process...")
+    enrol_outcomes = outcomes = run_enrolment_batches(
+        client,
+        "enrol_manual_enrol_users",
+        enrol_items,
+        role_id=STUDENT_ROLE_ID,
+        on_outcomes=journal and (lambda settled: journal.record("enrol", settled)),
+    )
+    for item, error in outcomes:
+        if error is None:
+            print(f"✅ Enrolled: {describe_item(item)}")
+        else:
+            print(f"❌ Enrol Failed: {describe_item(item)} ({error})")
+    fatal = next((error for _, error in outcomes if is_fatal_error(error)), None)
+    if fatal is not None:
+        # left in the journal as planned, so --resume sends them once access is fixed
+        print(f"⛔ Moodle refused access ({fatal}), not sending the {len(unenrol_items)} unenrolments")
+        return enrol_outcomes, []
+
+    # ----------------------------
+    # Unenrol users
+    # ----------------------------
+    print("\n🚀 Starting unenrol process...")
+    unenrol_outcomes = outcomes = run_enrolment_batches(
+        client,
+        "enrol_manual_unenrol_users",
+        unenrol_items,
+        on_outcomes=journal and (lambda settled: journal.record("unenrol", settled)),
+    )
+    for item, error in outcomes:
+        if error is None:
+            print(f"✅ Unenrolled: {describe_item(item)}")
+        else:
+            print(f"❌ Unenrol Failed: {describe_item(item)} ({error})")
+    return enrol_outcomes, unenrol_outcomes
+
+
+# =========================================================
+# ⑨ reconciliation
+# =========================================================
+def match_enrolments(df_current, df_unit):
+    """(email, short_name) rows for every enrolment matched to a unit."""
+    with PROFILER.stage("build_campus_tree"):
+        campus_tree, code_index = build_campus_tree(df_current)
+    module_dict = build_module_dict(df_unit)
+    with PROFILER.stage("generate_mapping"):
+        result = generate_mapping(campus_tree, module_dict, code_index)
+
+    with PROFILER.stage("merge"):
+        result_df = pd.DataFrame(result, columns=["timetable_id", "short_name"]).rename(
+            columns={"timetable_id": "TimetableID"}
+        )
+        # load_sheet already keeps just the two columns, and the inner merge drops unmatched rows
+        merged_df = pd.merge(df_current, result_df, on="TimetableID", how="inner")
+        return merged_df[["Email2", "short_name"]].rename(columns={"Email2": "email"})
+
+
+def match_timetable_ids(timetable_ids, module_dict, course_map, units=None):
+    """TimetableID -> [course_id, ...] for a batch of previously unseen IDs.
+
+    A TimetableID's matches only depend on the ID itself and module_dict,
+    so batches can be matched independently and the results reused; pass
+    units (CLASSIFIER.classify_units(module_dict)) to classify it only once.
+    """
+    with PROFILER.stage("build_campus_tree"):
+        campus_tree, code_index = build_campus_tree(pd.DataFrame({"TimetableID": timetable_ids}))
+    with PROFILER.stage("generate_mapping"):
+        result = generate_mapping(campus_tree, module_dict, code_index, units=units)
+    matches = dict.fromkeys(timetable_ids, ())
+    for row in result:
+        course_id = course_map.get(row["short_name"])
+        if course_id is not None:
+            matches[row["timetable_id"]] += (course_id,)
+    return matches
+
+
+def stream_target_enrol(path, module_dict, course_map, chunk_rows=STREAM_CHUNK_ROWS):
+    """build_target_enrol(match_enrolments(...)) without loading the export.
+
+    Each chunk is matched through the TimetableID -> course_id cache and
+    folded straight into the per-course sets, so memory is bounded by the
+    chunk size plus the target sets and the matched TimetableIDs (one per
+    class). IDs that match no course (tutorials, other terms, typos) are
+    only remembered until more than a chunk's worth have piled up. The
+    units are classified once, not per chunk.
+    """
     target_enrol = {}
-    for _, row in final_df.iterrows():
-        email = row["email"]
-        course_id = row["course_id"]
-        target_enrol.setdefault(course_id, set()).add(email)
+    tid_courses = {}
+    unmatched = set()
+    units = CLASSIFIER.classify_units(module_dict)
+    for chunk in iter_sheet_chunks(path, CURRENT_COLUMNS, chunk_rows):
+        tids = chunk["TimetableID"]
+        unseen = [t for t in tids.dropna().unique() if t not in tid_courses and t not in unmatched]
+        if unseen:
+            matches = match_timetable_ids(unseen, module_dict, course_map, units)
+            misses = [t for t, courses in matches.items() if not courses]
+            if len(unmatched) + len(misses) > chunk_rows:
+                unmatched = set()
+            unmatched.update(misses)
+            tid_courses.update((t, courses) for t, courses in matches.items() if courses)
 
-    # =========================================================
-    # Step 4. compare and generate enrol/unenrol lists
-    # =========================================================
+        add_matched_rows(target_enrol, tids.tolist(), chunk["Email2"].tolist(), tid_courses)
+    return target_enrol
+
+
+def add_matched_rows(target_enrol, tids, emails, tid_courses):
+    """Fold (TimetableID, email) rows into target_enrol via a TimetableID -> courses map."""
+    for tid, email in zip(tids, emails):
+        for course_id in tid_courses.get(tid, ()):
+            target_enrol.setdefault(course_id, set()).add(email)
+
+
+def build_target_enrol(final_df, course_map):
+    """course_id -> set of target emails, grouped column-wise."""
+    known = final_df["short_name"].isin(course_map.keys())
+    emails = final_df["email"][known]
+    course_ids = final_df["short_name"][known].map(course_map)
+    if emails.empty:
+        return {}
+    return emails.groupby(course_ids.to_numpy(), sort=False).agg(set).to_dict()
+
+
+def canonical_email(email):
+    """The one form emails are compared, cached and looked up in."""
+    return str(email).strip().lower()
+
+
+def is_student_email(email):
+    return bool(student_email_pattern.fullmatch(str(email)))
+
+
+class EmailInterner:
+    """Dense integer IDs for canonical emails, with the student flag computed once per email.
+
+    Raw spellings map to the ID of their canonical form, so "A@x.edu " in
+    the spreadsheet and "a@x.edu" from Moodle are the same person. A raw
+    spelling that differs from its canonical form is stored as ~ID, so
+    intern can tell which memberships needed normalising without another
+    pass over the strings.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.raw_ids = {}
+        self._emails = []
+        self._student = np.zeros(0, dtype=bool)
+
+    def _id(self, email):
+        canonical = canonical_email(email)
+        # setdefault evaluates len(ids) before inserting, so new emails get the next ID
+        i = self.ids.setdefault(canonical, len(self.ids))
+        i = self.raw_ids[email] = i if canonical == email else ~i
+        return i
+
+    def intern(self, emails):
+        """(sorted unique int array of the canonical IDs of `emails`, whether any was respelled)."""
+        raw_ids = self.raw_ids
+        arr = np.fromiter(
+            (raw_ids[e] if e in raw_ids else self._id(e) for e in emails), dtype=np.int64
+        )
+        respelled = bool(len(arr)) and arr.min() < 0
+        if respelled:
+            arr = np.where(arr < 0, ~arr, arr)
+        return np.unique(arr), respelled
+
+    @property
+    def emails(self):
+        if len(self._emails) < len(self.ids):
+            self._emails.extend(list(self.ids)[len(self._emails):])
+        return self._emails
+
+    @property
+    def student(self):
+        """Bool array indexed by ID: is that email a student account."""
+        done = len(self._student)
+        if done < len(self.ids):
+            new = pd.Series(self.emails[done:], dtype=object)
+            flags = new.str.fullmatch(student_email_pattern).fillna(False).to_numpy(dtype=bool)
+            self._student = np.concatenate([self._student, flags])
+        return self._student
+
+
+def intern_memberships(data, interner):
+    """course_id -> set of emails  =>  (course_id -> sorted int array, course_ids with a respelled email)."""
+    interned, respelled = {}, set()
+    for course_id, emails in data.items():
+        interned[course_id], changed = interner.intern(emails)
+        if changed:
+            respelled.add(course_id)
+    return interned, respelled
+
+
+def diff_memberships(course_map, current_ids, target_ids, interner, on_course=None):
+    """to_enrol / to_unenrol records; on_course(enrol, unenrol) sees each course's share as it is diffed."""
     to_enrol, to_unenrol = [], []
+    empty = np.zeros(0, dtype=np.int64)
+    emails = interner.emails
+    student = interner.student
 
     for shortname, course_id in course_map.items():
-        current = enrolled_data.get(course_id, set())
-        target = target_enrol.get(course_id, set())
+        current = current_ids.get(course_id, empty)
+        target = target_ids.get(course_id, empty)
+
+        new_users = np.setdiff1d(target, current, assume_unique=True)
+        wrong_users = np.setdiff1d(current, target, assume_unique=True)
+        wrong_users = wrong_users[student[wrong_users]]
+
+        enrol = [
+            {"email": emails[i], "course_id": course_id, "shortname": shortname}
+            for i in new_users
+        ]
+        unenrol = [
+            {"email": emails[i], "course_id": course_id, "shortname": shortname}
+            for i in wrong_users
+        ]
+        to_enrol.extend(enrol)
+        to_unenrol.extend(unenrol)
+        if on_course is not None:
+            on_course(enrol, unenrol)
+    return to_enrol, to_unenrol
+
+
+def normalisation_churn(courses, current, target, to_enrol, to_unenrol):
+    """How the canonical diff of `courses` differs from an exact-string one.
+
+    Returns {"enrol": (removed, added), "unenrol": (removed, added)}: records
+    the exact-string diff has that the canonical one doesn't, and the other
+    way round. Only pass the courses with a respelled email; elsewhere the
+    two diffs are identical.
+    """
+    churn = {}
+    for kind, records in (("enrol", to_enrol), ("unenrol", to_unenrol)):
+        canonical = {}
+        for r in records:
+            if r["course_id"] in courses:
+                canonical.setdefault(r["course_id"], set()).add(r["email"])
+        removed = added = 0
+        for course_id in courses:
+            cur, tgt = current.get(course_id, set()), target.get(course_id, set())
+            if kind == "enrol":
+                raw = tgt - cur
+            else:
+                raw = {e for e in cur - tgt if is_student_email(e)}
+            ours = canonical.get(course_id, set())
+            matched = len({canonical_email(e) for e in raw} & ours)
+            removed += len(raw) - matched
+            added += len(ours) - matched
+        churn[kind] = (removed, added)
+    return churn
+
+
+def diff_enrolments(course_map, enrolled_data, target_enrol, interner=None, on_course=None):
+    """to_enrol / to_unenrol records; only student accounts are ever unenrolled.
+
+    Both sides are interned by canonical email to sorted int arrays first,
+    so the per-course diff is a vectorised setdiff and the student check is
+    a mask lookup. Records carry the canonical email.
+    """
+    interner = interner or EmailInterner()
+    fetch_ids = set(course_map.values())
+    current = {c: v for c, v in enrolled_data.items() if c in fetch_ids}
+    target = {c: v for c, v in target_enrol.items() if c in fetch_ids}
+    current_ids, current_respelled = intern_memberships(current, interner)
+    target_ids, target_respelled = intern_memberships(target, interner)
+    to_enrol, to_unenrol = diff_memberships(course_map, current_ids, target_ids, interner, on_course)
+
+    # only the courses where some spelling needed normalising can differ from an exact-string diff
+    respelled = current_respelled | target_respelled
+    if respelled:
+        churn = normalisation_churn(respelled, current, target, to_enrol, to_unenrol)
+        (enrol_removed, enrol_added), (unenrol_removed, unenrol_added) = churn["enrol"], churn["unenrol"]
+        print(
+            f"🧹 Email normalisation removed {enrol_removed} spurious enrol and {unenrol_removed} "
+            f"spurious unenrol records, added {enrol_added} enrol and {unenrol_added} unenrol records"
+        )
+    return to_enrol, to_unenrol
+
+
+# =========================================================
+# ⑩ delta state between runs
+# =========================================================
+DELTA_STATE_PATH = os.path.join(CACHE_DIR, "delta_state.pkl")
+
+
+def load_delta_state(path=DELTA_STATE_PATH):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable delta state {path}: {e}")
+        return None
+
+
+def save_delta_state(state, path=DELTA_STATE_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
 
-        new_users = target - current
-        wrong_users = current - target
 
-        for email in new_users:
-            to_enrol.append(
-                {"email": email, "course_id": course_id, "shortname": shortname}
+def affected_courses(state, course_map, target_enrol):
+    """course_ids whose target set changed, or that the last run didn't finish."""
+    if state is None:
+        return set(course_map.values())
+    done, previous = state["done"], state["target_enrol"]
+    return {
+        course_id
+        for course_id in course_map.values()
+        if course_id not in done
+        or previous.get(course_id, set()) != target_enrol.get(course_id, set())
+    }
+
+
+def next_delta_state(state, inputs, target_enrol, reconciled, pending=()):
+    """Carry unaffected courses over and record the ones reconciled now.
+
+    pending courses still have changes to apply, so they leave "done" and
+    the next delta run diffs them again.
+    """
+    done = set(state["done"]) if state else set()
+    previous = dict(state["target_enrol"]) if state else {}
+    for course_id in reconciled:
+        done.add(course_id)
+        previous[course_id] = target_enrol.get(course_id, set())
+    done.difference_update(pending)
+    return {"inputs": inputs, "done": done, "target_enrol": previous}
+
+
+def unsettled_courses(to_enrol, to_unenrol, outcomes=None):
+    """course_ids with diff records that were not applied successfully.
+
+    outcomes is apply_changes' (enrol_outcomes, unenrol_outcomes), or None
+    when nothing was applied (dry run), in which case every record counts.
+    """
+    applied = set()
+    for settled in outcomes or ():
+        applied.update((item["email"], item["course_id"]) for item, error in settled if error is None)
+    return {
+        r["course_id"] for r in to_enrol + to_unenrol if (r["email"], r["course_id"]) not in applied
+    }
+
+
+# =========================================================
+# ⑪ enrolment journal
+# =========================================================
+JOURNAL_PATH = "./result/journal.jsonl"
+
+
+class EnrolmentJournal:
+    """Append-only JSONL log of planned and settled enrol/unenrol operations.
+
+    A "run" line opens each apply phase, followed by one "plan" line per
+    operation (user ID already resolved) and a "done" line per settled one.
+    Every write is flushed and fsynced, so after a crash the file says
+    exactly which operations still have to be sent.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _write(self, entries):
+        with self._lock:
+            self._file.writelines(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def start(self, enrol_items, unenrol_items):
+        entries = [{"op": "run", "started": time.time()}]
+        for kind, items in (("enrol", enrol_items), ("unenrol", unenrol_items)):
+            entries.extend({"op": "plan", "kind": kind, **item} for item in items)
+        self._write(entries)
+
+    def add_plan(self, kind, items):
+        """More "plan" lines for the current run, for callers that stream their operations."""
+        self._write({"op": "plan", "kind": kind, **item} for item in items)
+
+    def record(self, kind, settled):
+        self._write(
+            {
+                "op": "done",
+                "kind": kind,
+                "userid": item["userid"],
+                "course_id": item["course_id"],
+                "ok": error is None,
+                **({} if error is None else {"error": str(error)}),
+            }
+            for item, error in settled
+        )
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def pending(path=JOURNAL_PATH):
+        """Planned operations of the last run without a successful outcome.
+
+        Returns {"enrol": [...], "unenrol": [...]}, or None without a journal.
+        A torn last line from a crash mid-write is ignored.
+        """
+        if not os.path.exists(path):
+            return None
+        plan, done = {}, set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["op"] == "run":
+                    plan, done = {}, set()
+                elif entry["op"] == "plan":
+                    plan[(entry["kind"], entry["userid"], entry["course_id"])] = entry
+                elif entry["op"] == "done" and entry["ok"]:
+                    done.add((entry["kind"], entry["userid"], entry["course_id"]))
+        remaining = {"enrol": [], "unenrol": []}
+        for key, entry in plan.items():
+            if key not in done:
+                item = {k: v for k, v in entry.items() if k not in ("op", "kind")}
+                remaining[entry["kind"]].append(item)
+        return remaining
+
+
+# =========================================================
+# ⑫ stage profiling
+# =========================================================
+class StageProfiler:
+    """Wall time, CPU time and tracemalloc peak per named pipeline stage.
+
+    Stages nest (recorded as "match/generate_mapping") and repeat (the
+    per-chunk stages of --stream add up). With a profile_dir each stage
+    also collects a cProfile of its own code, nested stages excluded.
+    While disabled, stage() does nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_dir = None
+        self.stages = {}
+        self._stack = []
+        self._profiles = {}
+
+    def enable(self, profile_dir=None):
+        self.enabled = True
+        self.profile_dir = profile_dir
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        path = "/".join([frame["name"] for frame in self._stack] + [name])
+        # hand the running peak to the enclosing stages before resetting it
+        _, peak = tracemalloc.get_traced_memory()
+        for frame in self._stack:
+            frame["peak"] = max(frame["peak"], peak)
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+
+        parent = self._stack[-1] if self._stack else None
+        profile = None
+        if self.profile_dir:
+            if parent and parent["profile"]:
+                parent["profile"].disable()
+            profile = self._profiles.setdefault(path, cProfile.Profile())
+            profile.enable()
+
+        frame = {"name": name, "peak": base, "profile": profile}
+        self._stack.append(frame)
+        t0, c0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+            self._stack.pop()
+            if profile:
+                profile.disable()
+                if parent and parent["profile"]:
+                    parent["profile"].enable()
+            _, peak = tracemalloc.get_traced_memory()
+            entry = self.stages.setdefault(path, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak": 0})
+            entry["calls"] += 1
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            entry["peak"] = max(entry["peak"], max(frame["peak"], peak) - base)
+
+    def dump_profiles(self):
+        if not self.profile_dir or not self._profiles:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for path, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(self.profile_dir, f"{path.replace('/', '.')}.prof"))
+        print(f"💾 cProfile dumps in {self.profile_dir} (open with `python -m pstats`)")
+
+    def print_table(self):
+        if not self.stages:
+            return
+        print(f"\n⏱️ {'stage':<36}{'calls':>7}{'wall s':>9}{'cpu s':>9}{'peak MB':>9}")
+        for path, e in sorted(self.stages.items(), key=lambda kv: -kv[1]["wall"]):
+            print(
+                f"   {path:<36}{e['calls']:>7}{e['wall']:>9.3f}{e['cpu']:>9.3f}"
+                f"{e['peak'] / 2**20:>9.1f}"
             )
 
-        for email in wrong_users:
-            username, domain = email.split("@", 1)
-            if (
-                re.fullmatch(r"\d+", username)
-                and domain.lower() == "student.imc.edu.au"
-            ):
-                to_unenrol.append(
-                    {"email": email, "course_id": course_id, "shortname": shortname}
-                )
 
+PROFILER = StageProfiler()
+
+
+# =========================================================
+# ⑬ result writers
+# =========================================================
+RESULT_FORMATS = ("csv", "jsonl", "parquet", "xlsx")
+RESULT_FIELDS = ["email", "course_id", "shortname"]
+
+
+class ResultWriter:
+    """Append-as-you-go writer for enrol/unenrol records in one output format.
+
+    Records go to <path>.tmp and the file is renamed into place on close(),
+    so a crashed run never leaves a half-written result behind. Parquet is
+    written in row groups of RESULT_ROW_GROUP; xlsx uses openpyxl's
+    write-only mode and is meant for human review, not for large runs.
+    """
+
+    def __init__(self, path, fmt, row_group=RESULT_ROW_GROUP):
+        if fmt not in RESULT_FORMATS:
+            raise ValueError(f"unknown result format {fmt!r}, expected one of {RESULT_FORMATS}")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.fmt = fmt
+        self.row_group = row_group
+        self.count = 0
+        self._tmp = f"{path}.tmp"
+        self._buffer = []
+
+        if fmt == "csv":
+            self._file = open(self._tmp, "w", newline="", encoding="utf-8")
+            self._csv = csv.DictWriter(self._file, fieldnames=RESULT_FIELDS)
+            self._csv.writeheader()
+        elif fmt == "jsonl":
+            self._file = open(self._tmp, "w", encoding="utf-8")
+        elif fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self._schema = pa.schema(
+                [("email", pa.string()), ("course_id", pa.int64()), ("shortname", pa.string())]
+            )
+            self._parquet = pq.ParquetWriter(self._tmp, self._schema)
+        else:
+            from openpyxl import Workbook
+
+            self._workbook = Workbook(write_only=True)
+            self._sheet = self._workbook.create_sheet()
+            self._sheet.append(RESULT_FIELDS)
+
+    def write(self, records):
+        self.count += len(records)
+        if self.fmt == "csv":
+            self._csv.writerows(records)
+        elif self.fmt == "jsonl":
+            self._file.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        elif self.fmt == "parquet":
+            self._buffer.extend(records)
+            if len(self._buffer) >= self.row_group:
+                self._flush_row_group()
+        else:
+            for r in records:
+                self._sheet.append([r[k] for k in RESULT_FIELDS])
+
+    def _flush_row_group(self):
+        import pyarrow as pa
+
+        self._parquet.write_table(pa.Table.from_pylist(self._buffer, schema=self._schema))
+        self._buffer = []
+
+    def close(self):
+        if self.fmt in ("csv", "jsonl"):
+            self._file.close()
+        elif self.fmt == "parquet":
+            # an empty file still gets one (empty) row group, so readers see the schema
+            if self._buffer or not self.count:
+                self._flush_row_group()
+            self._parquet.close()
+        else:
+            self._workbook.save(self._tmp)
+        os.replace(self._tmp, self.path)
+
+
+def open_result_writers(formats, result_dir="./result"):
+    """{"to_enrol": [writer, ...], "to_unenrol": [writer, ...]}, one writer per format."""
+    return {
+        name: [ResultWriter(os.path.join(result_dir, f"{name}.{fmt}"), fmt) for fmt in formats]
+        for name in ("to_enrol", "to_unenrol")
+    }
+
+
+def parse_result_formats(value):
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in RESULT_FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(
+            f"unknown result format(s) {unknown}, expected some of {', '.join(RESULT_FORMATS)}"
+        )
+    if "parquet" in formats and importlib.util.find_spec("pyarrow") is None:
+        raise argparse.ArgumentTypeError("parquet output needs pyarrow installed")
+    return formats
+
+
+# =========================================================
+# ⑭ batch mode: several (enrolment, unit) file pairs in one run
+# =========================================================
+def load_manifest(path):
+    """[{"name", "current", "unit"}] from a JSON manifest.
+
+    name defaults to the unit file's stem and must be unique.
+    """
+    with open(path, encoding="utf-8") as f:
+        jobs = json.load(f)
+    for job in jobs:
+        job.setdefault("name", os.path.splitext(os.path.basename(job["unit"]))[0])
+    names = [job["name"] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate job names in {path}: {names}")
+    return jobs
+
+
+def run_match_job(job):
+    # runs in a worker process: local parsing and matching only, no API calls
+    df_unit = load_sheet(job["unit"], UNIT_COLUMNS)
+    df_current = load_sheet(job["current"], CURRENT_COLUMNS)
+    shortnames = df_unit["shortname"].dropna().unique().tolist()
+    return shortnames, match_enrolments(df_current, df_unit)
+
+
+def run_match_jobs(jobs, workers=BATCH_WORKERS):
+    """name -> (unit shortnames, matched email/short_name frame), in manifest order.
+
+    Every Moodle call stays in the parent process on one client, so the
+    jobs together share a single rate limit and ID cache.
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        futures = {pool.submit(run_match_job, job): job["name"] for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Matching jobs"):
+            results[futures[future]] = future.result()
+    return {job["name"]: results[job["name"]] for job in jobs}
+
+
+def merge_target_enrol(targets):
+    """Union per-job targets, so a course shared by two cohorts keeps both."""
+    merged = {}
+    for target in targets:
+        for course_id, emails in target.items():
+            merged.setdefault(course_id, set()).update(emails)
+    return merged
+
+
+# =========================================================
+# ⑮ diff / apply steps shared by one-shot and watch runs
+# =========================================================
+def open_result_sink(formats):
+    """(writers, write_course): write_course(enrol, unenrol) appends to every format."""
+    writers = open_result_writers(formats)
+
+    def write_course(enrol, unenrol):
+        for writer in writers["to_enrol"]:
+            writer.write(enrol)
+        for writer in writers["to_unenrol"]:
+            writer.write(unenrol)
+
+    return writers, write_course
+
+
+def close_result_sink(writers, to_enrol, to_unenrol):
     print(f"✅ To Enrol: {len(to_enrol)} records")
     print(f"✅ To Unenrol: {len(to_unenrol)} records")
 
-    os.makedirs("result", exist_ok=True)
-    pd.DataFrame(to_enrol).to_excel("./result/to_enrol.xlsx", index=False)
-    pd.DataFrame(to_unenrol).to_excel("./result/to_unenrol.xlsx", index=False)
-    print("💾 Save to_enrol.xlsx and to_unenrol.xlsx")
+    with PROFILER.stage("write_results"):
+        for writer in writers["to_enrol"] + writers["to_unenrol"]:
+            writer.close()
+    print(f"💾 Save {', '.join(os.path.basename(w.path) for w in writers['to_enrol'] + writers['to_unenrol'])}")
 
-    # =========================================================
-    # Step 5. Execute enrolment changes
-    # =========================================================
-    print("\n🚀 Step 5: Fetching user IDs in bulk...")
 
-    def fetch_user_ids_bulk(emails):
-        """Batch get user IDs via core_user_get_users_by_field"""
-        user_map = {}
-        batch_size = 50  # Moodle API can handle around 50 safely per call
+def write_diff(course_map, enrolled_data, target_enrol, formats):
+    """Diff the courses in course_map, streaming the records into the result files."""
+    # records are appended to the result files course by course as they are diffed
+    writers, write_course = open_result_sink(formats)
+    with PROFILER.stage("diff"):
+        to_enrol, to_unenrol = diff_enrolments(
+            course_map, enrolled_data, target_enrol, on_course=write_course
+        )
+    close_result_sink(writers, to_enrol, to_unenrol)
+    return to_enrol, to_unenrol
 
-        for i in tqdm(range(0, len(emails), batch_size), desc="Fetching user IDs"):
-            batch = emails[i:i+batch_size]
-            params = {
-                "field": "email",
-            }
-            for idx, email in enumerate(batch):
-                params[f"values[{idx}]"] = email
-            try:
-                data = moodle_api("core_user_get_users_by_field", params)
-                if isinstance(data, list):
-                    for user in data:
-                        if "email" in user and "id" in user:
-                            user_map[user["email"].lower()] = user["id"]
-            except Exception as e:
-                print(f"❌ Failed fetching batch starting {batch[0]}: {e}")
-            time.sleep(0.2)
-        return user_map
+
+def apply_diff(client, cache, to_enrol, to_unenrol):
+    """Resolve user IDs, write the plan and, with APPLY_CHANGES, send the changes through the journal.
+
+    Returns apply_changes' (enrol_outcomes, unenrol_outcomes), or None when
+    APPLY_CHANGES is off.
+    """
+    print("\n🚀 Step 5: Fetching user IDs in bulk...")
 
     # ----------------------------
     # Build user cache
     # ----------------------------
     
-    all_emails = list({i["email"].lower() for i in to_enrol + to_unenrol})
-    user_cache = fetch_user_ids_bulk(all_emails)
+    all_emails = [i["email"] for i in to_enrol + to_unenrol]
+    with PROFILER.stage("user_ids"):
+        user_cache = fetch_user_ids_bulk(client, all_emails, cache=cache)
     print(user_cache)
     
-    # ----------------------------
-    # Enrol users
-    # ----------------------------
-    STUDENT_ROLE_ID = 5  # Student role is 5
-
-    # print("\n🚀 Starting enrol process...")
-    # for item in tqdm(to_enrol, desc="Enrolling users"):
-    #     email = item["email"].lower()
-    #     userid = user_cache.get(email)
-    #     if not userid:
-    #         print(f"⚠️ Skip: user not found for {email}")
-    #         continue
-
-    #     enrol_data = {
-    #         "enrolments[0][roleid]": STUDENT_ROLE_ID,
-    #         "enrolments[0][userid]": userid,
-    #         "enrolments[0][courseid]": item["course_id"],
-    #     }
-
-    #     try:
-    #         moodle_api("enrol_manual_enrol_users", enrol_data)
-    #         print(f"✅ Enrolled: {email} -> {item['shortname']}")
-    #     except Exception as e:
-    #         print(f"❌ Enrol Failed: {email} ({e})")
-    #     time.sleep(0.2)
+    enrol_items = resolve_user_ids(to_enrol, user_cache)
+    unenrol_items = resolve_user_ids(to_unenrol, user_cache)
+    write_plan(PLAN_PATH, enrol_items, unenrol_items)
+    print(f"💾 Save {PLAN_PATH} ({len(enrol_items) + len(unenrol_items)} operations)")
+    if not APPLY_CHANGES:
+        print("ℹ️ APPLY_CHANGES is off, skipping enrol/unenrol (run `apply` to send the plan)")
+        return None
+    journal = EnrolmentJournal()
+    journal.start(enrol_items, unenrol_items)
+    with PROFILER.stage("apply"):
+        outcomes = apply_changes(client, enrol_items, unenrol_items, journal)
+    journal.close()
+    return outcomes
 
-    # ----------------------------
-    # Unenrol users
-    # ----------------------------
-    # print("\n🚀 Starting unenrol process...")
-    # for item in tqdm(to_unenrol, desc="Unenrolling users"):
-    #     email = item["email"].lower()
-    #     userid = user_cache.get(email)
-    #     if not userid:
-    #         print(f"⚠️ Skip: user not found for {email}")
-    #         continue
-
-    #     unenrol_data = {
-    #         "enrolments[0][userid]": userid,
-    #         "enrolments[0][courseid]": item["course_id"],
-    #     }
-
-    #     try:
-    #         moodle_api("enrol_manual_unenrol_users", unenrol_data)
-    #         print(f"✅ Unenrolled: {email} -> {item['shortname']}")
-    #     except Exception as e:
-    #         print(f"❌ Unenrol Failed: {email} ({e})")
-    #     time.sleep(0.2)
\ No newline at end of file
+
+# =========================================================
+# ⑯ sharded reconciliation: fetch + diff per course shard in worker processes
+# =========================================================
+def partition_courses(course_map, target_enrol, n_shards):
+    """Split course_map into n_shards dicts of roughly equal work.
+
+    Courses go largest-first to the lightest shard, weighted by target
+    size (plus one for the fetch itself), so one huge unit doesn't leave
+    the other workers idle.
+    """
+    shards = [{} for _ in range(n_shards)]
+    loads = [0] * n_shards
+    by_size = sorted(course_map.items(), key=lambda kv: -len(target_enrol.get(kv[1], ())))
+    for short_name, course_id in by_size:
+        lightest = loads.index(min(loads))
+        shards[lightest][short_name] = course_id
+        loads[lightest] += 1 + len(target_enrol.get(course_id, ()))
+    return [shard for shard in shards if shard]
+
+
+def reconcile_shard(shard_map, target, budget):
+    """Worker: fetch + diff one shard on its own client with its share of the budget."""
+    client = MoodleClient(
+        budget["url"],
+        budget["token"],
+        concurrency=budget["concurrency"],
+        rate=RateController(rate=budget["rate"], max_rate=budget["max_rate"]),
+        max_retries=budget["max_retries"],
+    )
+    try:
+        enrolled_data = fetch_enrolled_emails(client, shard_map)
+        # a course whose fetch failed is not "nobody enrolled": leave it out of the diff
+        fetched_map = {s: c for s, c in shard_map.items() if c in enrolled_data}
+        to_enrol, to_unenrol = diff_enrolments(fetched_map, enrolled_data, target)
+        return list(enrolled_data), to_enrol, to_unenrol, client.stats.functions
+    finally:
+        client.close()
+
+
+def reconcile_sharded(client, course_map, target_enrol, n_shards, on_course=None):
+    """Steps 3-4 over n_shards worker processes; returns (fetched course_ids, to_enrol, to_unenrol).
+
+    Each worker gets 1/n of the client's concurrency and of its current
+    and maximum rate, so together they stay within the single-process
+    budget; n is capped at the client's concurrency, since every worker
+    needs at least one connection. Workers are spawned rather than forked,
+    so they don't inherit this process's client threads and session.
+    Worker API stats are merged into client.stats, and each shard's
+    records reach on_course as soon as that shard finishes.
+    """
+    if n_shards > client.concurrency:
+        print(f"⚠️ {n_shards} shards exceed MOODLE_CONCURRENCY, using {client.concurrency}")
+        n_shards = client.concurrency
+    shards = partition_courses(course_map, target_enrol, n_shards)
+    n = max(1, len(shards))
+    budget = {
+        "url": client.url,
+        "token": client.token,
+        "concurrency": client.concurrency // n,
+        "rate": client.rate.rate / n,
+        "max_rate": client.rate.max_rate / n,
+        "max_retries": client.max_retries,
+    }
+    fetched, to_enrol, to_unenrol = [], [], []
+    with ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(
+                reconcile_shard,
+                shard,
+                {c: target_enrol[c] for c in shard.values() if c in target_enrol},
+                budget,
+            )
+            for shard in shards
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Reconciling shards"):
+            shard_fetched, shard_enrol, shard_unenrol, functions = future.result()
+            client.stats.merge(functions)
+            fetched.extend(shard_fetched)
+            to_enrol.extend(shard_enrol)
+            to_unenrol.extend(shard_unenrol)
+            if on_course is not None:
+                on_course(shard_enrol, shard_unenrol)
+    return fetched, to_enrol, to_unenrol
+
+
+# =========================================================
+# ⑰ watch mode: a warm, long-running reconciler
+# =========================================================
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class WarmPipeline:
+    """Reconciler that keeps every intermediate result in memory between runs.
+
+    Sheets are re-parsed only when their hash changes, TimetableIDs are
+    matched once per unit file, course/user IDs stay cached, and each
+    course's enrolled emails are fetched once and then kept current from
+    our own apply outcomes. A run only diffs, and only calls Moodle for,
+    courses whose target changed plus courses left dirty by a failed fetch
+    or by changes not applied yet. Every WATCH_RESYNC seconds the enrolment sets are dropped so
+    changes made directly in Moodle are picked up again.
+    """
+
+    def __init__(self, client, cache, current_path, unit_path, formats):
+        self.client = client
+        self.cache = cache
+        self.current_path = current_path
+        self.unit_path = unit_path
+        self.formats = formats
+        self.hashes = {}
+        self.df_current = None
+        self.module_dict = {}
+        self.units = {}  # classified module_dict
+        self.course_map = {}  # every shortname resolved so far
+        self.unit_map = {}  # the current unit file's shortname -> course_id
+        self.tid_courses = {}
+        self.enrolled = {}
+        self.target = {}  # target per course as of its last reconciliation
+        self.dirty = set()
+        self.synced_at = time.monotonic()
+
+    def _reload(self):
+        changed = []
+        for path in (self.unit_path, self.current_path):
+            digest = file_sha256(path)
+            if self.hashes.get(path) != digest:
+                self.hashes[path] = digest
+                changed.append(path)
+
+        if self.unit_path in changed:
+            with PROFILER.stage("load_units"):
+                df_unit = load_sheet(self.unit_path, UNIT_COLUMNS)
+            self.module_dict = build_module_dict(df_unit)
+            self.units = CLASSIFIER.classify_units(self.module_dict)
+            shortnames = df_unit["shortname"].dropna().unique().tolist()
+            missing = [s for s in shortnames if s not in self.course_map]
+            if missing:
+                with PROFILER.stage("course_ids"):
+                    self.course_map.update(fetch_course_ids(self.client, missing, self.cache))
+            self.unit_map = {s: self.course_map[s] for s in shortnames if s in self.course_map}
+            # matches depend on the unit file, so they start over with it
+            self.tid_courses = {}
+        if self.current_path in changed:
+            with PROFILER.stage("load_current"):
+                self.df_current = load_sheet(self.current_path, CURRENT_COLUMNS)
+        return changed
+
+    def run(self):
+        """Reconcile whatever changed; returns (to_enrol, to_unenrol), or None if nothing did."""
+        if not self._reload():
+            return None
+        if time.monotonic() - self.synced_at > WATCH_RESYNC:
+            self.enrolled = {}
+            self.synced_at = time.monotonic()
+
+        with PROFILER.stage("target"):
+            tids = self.df_current["TimetableID"]
+            unseen = [t for t in tids.dropna().unique() if t not in self.tid_courses]
+            if unseen:
+                self.tid_courses.update(
+                    match_timetable_ids(unseen, self.module_dict, self.unit_map, self.units)
+                )
+            target_enrol = {}
+            add_matched_rows(
+                target_enrol, tids.tolist(), self.df_current["Email2"].tolist(), self.tid_courses
+            )
+
+        state = {"done": self.enrolled.keys() - self.dirty, "target_enrol": self.target}
+        affected = affected_courses(state, self.unit_map, target_enrol)
+        cold = {s: c for s, c in self.unit_map.items() if c in affected and c not in self.enrolled}
+        with PROFILER.stage("enrolled"):
+            fetched = fetch_enrolled_emails(self.client, cold)
+        # canonical, so our own apply outcomes can be folded back in exactly
+        self.enrolled.update(
+            {course_id: {canonical_email(e) for e in emails} for course_id, emails in fetched.items()}
+        )
+        fetch_map = {s: c for s, c in self.unit_map.items() if c in affected and c in self.enrolled}
+        print(f"🔁 {len(fetch_map)} of {len(self.unit_map)} units affected, {len(cold)} fetched")
+
+        to_enrol, to_unenrol = write_diff(fetch_map, self.enrolled, target_enrol, self.formats)
+        for course_id in fetch_map.values():
+            self.target[course_id] = target_enrol.get(course_id, set())
+        # a failed fetch leaves its course dirty for the next run
+        self.dirty = affected - set(fetch_map.values())
+
+        outcomes = apply_diff(self.client, self.cache, to_enrol, to_unenrol)
+        if outcomes is not None:
+            enrol_outcomes, unenrol_outcomes = outcomes
+            for settled, update in ((enrol_outcomes, set.add), (unenrol_outcomes, set.discard)):
+                for item, error in settled:
+                    if error is None:
+                        update(self.enrolled[item["course_id"]], item["email"])
+        # dry-run, failed and unresolved operations stay pending, so their
+        # courses are diffed (and written out) again on the next run
+        self.dirty |= unsettled_courses(to_enrol, to_unenrol, outcomes)
+        return to_enrol, to_unenrol
+
+
+def watch(pipeline, paths, interval=WATCH_INTERVAL):
+    """Run the pipeline now and again after every completed change to `paths`.
+
+    A change counts once the files' mtime and size have held still for one
+    poll interval, so a half-copied export is never read.
+    """
+    print(f"👀 Watching {', '.join(paths)} every {interval:g}s (Ctrl+C to stop)")
+    seen, pending = None, None
+    while True:
+        current = {path: file_signature(path) for path in paths}
+        if current != seen and None not in current.values():
+            if seen is None or current == pending:
+                t0 = time.perf_counter()
+                try:
+                    result = pipeline.run()
+                except Exception as e:
+                    print(f"❌ Reconciliation failed, will retry on the next change: {e}")
+                else:
+                    if result is not None:
+                        print(f"⚡ Reconciled in {time.perf_counter() - t0:.1f}s")
+                seen, pending = current, None
+            else:
+                pending = current
+        time.sleep(interval)
+
+
+# =========================================================
+# ⑱ cached unit index and quick queries
+# =========================================================
+UNIT_INDEX_PATH = os.path.join(CACHE_DIR, "unit_index.sqlite3")
+
+
+class UnitIndex:
+    """shortname <-> canonical email pairs from the last match, in SQLite.
+
+    Every run that matches rewrites it. Reading needs neither pandas nor
+    the spreadsheets, so single-unit and single-student lookups are
+    near-instant. meta records the input hashes it was built from.
+    """
+
+    def __init__(self, path=UNIT_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            " shortname TEXT NOT NULL, email TEXT NOT NULL,"
+            " PRIMARY KEY (shortname, email)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS members_email ON members (email)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS units (shortname TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def replace(self, pairs, shortnames, inputs):
+        with self.conn:
+            self.conn.execute("DELETE FROM members")
+            self.conn.execute("DELETE FROM units")
+            self.conn.executemany("INSERT OR IGNORE INTO members VALUES (?, ?)", pairs)
+            self.conn.executemany("INSERT OR IGNORE INTO units VALUES (?)", ((s,) for s in shortnames))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("inputs", json.dumps(inputs)), ("built_at", str(time.time()))],
+            )
+
+    def members(self, shortname):
+        """Sorted target emails of a unit, or None if the unit isn't in the index."""
+        if self.conn.execute("SELECT 1 FROM units WHERE shortname = ?", (shortname,)).fetchone() is None:
+            return None
+        rows = self.conn.execute(
+            "SELECT email FROM members WHERE shortname = ? ORDER BY email", (shortname,)
+        )
+        return [email for (email,) in rows]
+
+    def units_of(self, email):
+        rows = self.conn.execute(
+            "SELECT shortname FROM members WHERE email = ? ORDER BY shortname",
+            (canonical_email(email),),
+        )
+        return [shortname for (shortname,) in rows]
+
+    def meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def stale_inputs(self):
+        """Input files changed or gone since the index was built."""
+        inputs = json.loads(self.meta("inputs") or "{}")
+        return [
+            path for path, digest in inputs.items()
+            if not os.path.exists(path) or file_sha256(path) != digest
+        ]
+
+    def close(self):
+        self.conn.close()
+
+
+def save_unit_index(final_df, shortnames, inputs, path=UNIT_INDEX_PATH):
+    index = UnitIndex(path)
+    try:
+        pairs = zip(final_df["short_name"].tolist(), map(canonical_email, final_df["email"].tolist()))
+        index.replace(pairs, shortnames, inputs)
+    finally:
+        index.close()
+
+
+def open_unit_index():
+    """The index, with a warning if it is missing or behind the input files."""
+    if not os.path.exists(UNIT_INDEX_PATH):
+        print(f"❌ No unit index at {UNIT_INDEX_PATH}, run `match` first")
+        return None
+    index = UnitIndex()
+    built_at = float(index.meta("built_at") or 0)
+    print(f"🗂️ Unit index built {time.strftime('%Y-%m-%d %H:%M', time.localtime(built_at))}")
+    stale = index.stale_inputs()
+    if stale:
+        print(f"⚠️ Changed since then: {', '.join(stale)} (run `match` to refresh)")
+    return index
+
+
+def query_unit(shortname, offline=False):
+    """Target students of one unit and, unless offline, what a run would change there."""
+    index = open_unit_index()
+    if index is None:
+        return 1
+    members = index.members(shortname)
+    index.close()
+    if members is None:
+        print(f"❌ {shortname} is not in the Unit Creation sheet")
+        return 1
+    print(f"📘 {shortname}: {len(members)} target students")
+    if offline:
+        for email in members:
+            print(f"   {email}")
+        return 0
+
+    client = get_client()
+    cache = IdCache(os.path.join(CACHE_DIR, "id_cache.sqlite3"))
+    course_map = cache.get_many("course", [shortname])
+    if not course_map:
+        course_map = fetch_course_ids_by_shortname(client, [shortname])
+        cache.put_many("course", course_map, COURSE_CACHE_TTL)
+    if not course_map:
+        print(f"❌ {shortname} does not exist in Moodle")
+        return 1
+    course_id = course_map[shortname]
+    enrolled = fetch_enrolled_emails(client, course_map).get(course_id)
+    if enrolled is None:
+        return 1
+
+    current = {canonical_email(e) for e in enrolled}
+    target = set(members)
+    to_enrol = sorted(target - current)
+    to_unenrol = sorted(e for e in current - target if is_student_email(e))
+    print(f"👥 {len(current)} enrolled in Moodle (course {course_id})")
+    print(f"✅ To Enrol: {len(to_enrol)}")
+    for email in to_enrol:
+        print(f"   + {email}")
+    print(f"✅ To Unenrol: {len(to_unenrol)}")
+    for email in to_unenrol:
+        print(f"   - {email}")
+    return 0
+
+
+def query_student(email):
+    """Units a student is matched to in the index."""
+    index = open_unit_index()
+    if index is None:
+        return 1
+    units = index.units_of(email)
+    index.close()
+    print(f"🎓 {canonical_email(email)}: {len(units)} units")
+    for shortname in units:
+        print(f"   {shortname}")
+    return 0
+
+
+# =========================================================
+# ⑲ binary plan: resolved operations for a later, lookup-free apply
+# =========================================================
+PLAN_PATH = "./result/plan.npy"
+PLAN_ENROL, PLAN_UNENROL = 1, 2
+PLAN_OPS = {PLAN_ENROL: ("enrol", "enrol_manual_enrol_users"), PLAN_UNENROL: ("unenrol", "enrol_manual_unenrol_users")}
+
+
+def plan_dtype():
+    # 17 bytes per operation, unpadded
+    return np.dtype([("user_id", "<i8"), ("course_id", "<i8"), ("op", "u1")])
+
+
+def write_plan(path, enrol_items, unenrol_items):
+    """Save resolved operations as a .npy structured array (np.load(..., mmap_mode="r") to read)."""
+    plan = np.empty(len(enrol_items) + len(unenrol_items), dtype=plan_dtype())
+    for offset, op, items in ((0, PLAN_ENROL, enrol_items), (len(enrol_items), PLAN_UNENROL, unenrol_items)):
+        rows = plan[offset:offset + len(items)]
+        rows["user_id"] = [item["userid"] for item in items]
+        rows["course_id"] = [item["course_id"] for item in items]
+        rows["op"] = op
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, plan)
+    os.replace(tmp, path)
+
+
+def plan_keys(user_ids, course_ids):
+    # one int64 per (course, user); Moodle IDs stay far below 2**31
+    return (np.asarray(course_ids, dtype=np.int64) << 32) | np.asarray(user_ids, dtype=np.int64)
+
+
+def precheck_plan(client, plan):
+    """Mask of plan rows still needed: enrols of users not yet enrolled, unenrols of enrolled ones.
+
+    One paged enrolled-users fetch (IDs only) per course in the plan; a
+    course whose fetch fails keeps all its operations.
+    """
+    course_ids = np.unique(plan["course_id"])
+    enrolled = fetch_enrolled_emails(client, {str(c): int(c) for c in course_ids}, field="id")
+    checked = np.isin(plan["course_id"], np.fromiter(enrolled, dtype=np.int64, count=len(enrolled)))
+    current = np.concatenate(
+        [plan_keys(list(users), [c] * len(users)) for c, users in enrolled.items()]
+        + [np.zeros(0, dtype=np.int64)]
+    )
+    present = np.isin(plan_keys(plan["user_id"], plan["course_id"]), current)
+    satisfied = checked & np.where(plan["op"] == PLAN_ENROL, present, ~present)
+    return ~satisfied
+
+
+def plan_chunks(plan, needed, chunk_rows):
+    """Yield (op, items) for the needed plan rows, chunk_rows operations at a time."""
+    for op in PLAN_OPS:
+        rows = np.flatnonzero(needed & (plan["op"] == op))
+        for start in range(0, len(rows), chunk_rows):
+            chunk = plan[rows[start:start + chunk_rows]]
+            yield op, [
+                {"userid": int(u), "course_id": int(c)}
+                for u, c in zip(chunk["user_id"], chunk["course_id"])
+            ]
+
+
+def apply_plan(client, path=PLAN_PATH, precheck=True, chunk_rows=PLAN_CHUNK_ROWS):
+    """Stream a plan into batched enrol/unenrol calls; no user or course lookups.
+
+    The plan is memory-mapped and read chunk_rows operations at a time.
+    Every needed operation is journaled before the first one is sent, so
+    `--resume` after a crash picks up the whole remainder, as with
+    apply_changes. Replaying an applied plan is a no-op: the pre-check
+    finds every operation already satisfied.
+    """
+    plan = np.load(path, mmap_mode="r")
+    print(f"📦 {path}: {int((plan['op'] == PLAN_ENROL).sum())} enrol, {int((plan['op'] == PLAN_UNENROL).sum())} unenrol operations")
+    needed = np.ones(len(plan), dtype=bool)
+    if precheck and len(plan):
+        with PROFILER.stage("precheck"):
+            needed = precheck_plan(client, plan)
+        print(f"🔎 Pre-check: {int((~needed).sum())} already satisfied, {int(needed.sum())} to send")
+
+    journal = EnrolmentJournal()
+    journal.start([], [])
+    for op, items in plan_chunks(plan, needed, chunk_rows):
+        journal.add_plan(PLAN_OPS[op][0], items)
+    failed = sent = 0
+    with PROFILER.stage("apply"):
+        for op, items in plan_chunks(plan, needed, chunk_rows):
+            kind, wsfunction = PLAN_OPS[op]
+            outcomes = run_enrolment_batches(
+                client,
+                wsfunction,
+                items,
+                role_id=STUDENT_ROLE_ID if op == PLAN_ENROL else None,
+                on_outcomes=lambda settled, kind=kind: journal.record(kind, settled),
+            )
+            sent += len(outcomes)
+            for item, error in outcomes:
+                if error is not None:
+                    failed += 1
+                    print(f"❌ {kind.capitalize()} Failed: {describe_item(item)} ({error})")
+            fatal = next((error for _, error in outcomes if is_fatal_error(error)), None)
+            if fatal is not None:
+                # the rest of the plan is journaled already, for --resume
+                print(f"⛔ Moodle refused access ({fatal}), not sending the rest of the plan")
+                break
+    journal.close()
+    print(f"✅ Applied {sent - failed} of {sent} operations, {failed} failed")
+    return failed
+
+
+# =========================================================
+# ⑳ Main Process
+# =========================================================
+COMMANDS = {
+    "run": "full reconciliation; applies changes only with APPLY_CHANGES=1 (default)",
+    "match": "parse and match the spreadsheets only, refresh the unit index; no API calls",
+    "diff": "full reconciliation that writes the result files and the plan, never applies",
+    "apply": "send the operations of the plan from `diff`, skipping ones already satisfied",
+    "unit": "TARGET is a shortname: its target students and pending changes, from the unit index",
+    "student": "TARGET is an email: the units it is matched to, from the unit index",
+}
+
+def finish(args, code=0):
+    """Shared exit of every command: API stats if Moodle was called, then the stage profile."""
+    if _default_client is not None:
+        _default_client.stats.report(args.stats_file, args.prom_file)
+    PROFILER.print_table()
+    PROFILER.dump_profiles()
+    raise SystemExit(code)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {c:<9}{h}" for c, h in COMMANDS.items()),
+    )
+    parser.add_argument("command", nargs="?", default="run", choices=list(COMMANDS))
+    parser.add_argument("target", nargs="?", default=None, help="shortname for `unit`, email for `student`")
+    parser.add_argument(
+        "--plan", default=PLAN_PATH, help="`apply` only: plan file to send (default %(default)s)"
+    )
+    parser.add_argument(
+        "--no-precheck",
+        action="store_true",
+        help="`apply` only: send every planned operation without checking current enrolments",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="`unit` only: list the target students without asking Moodle",
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="ignore cached course/user IDs and refetch them"
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="only refetch and diff courses whose target enrolment changed since the last run",
+    )
+    parser.add_argument(
+        "--stats-file",
+        default="./result/api_stats.json",
+        help="where to write the per-wsfunction API summary",
+    )
+    parser.add_argument(
+        "--prom-file", default=None, help="also write API metrics in Prometheus text format"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the enrolment export in row chunks instead of loading it whole",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="MANIFEST",
+        default=None,
+        help='JSON list of {"name", "current", "unit"} file pairs to reconcile in one run',
+    )
+    parser.add_argument(
+        "--enrolments-file",
+        default=None,
+        help="read current enrolments from a Moodle enrolment export (.csv/.xlsx) "
+        "instead of core_enrol_get_enrolled_users",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=parse_result_formats,
+        default=RESULT_FORMAT,
+        help="comma separated result formats for to_enrol/to_unenrol: "
+        "csv, jsonl, parquet, xlsx (xlsx is for human review)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="time each pipeline stage (wall, CPU, peak memory) and print a summary",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="with --profile, also write a cProfile dump per stage to this directory",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=RECONCILE_SHARDS,
+        help="fetch and diff courses in this many worker processes, splitting the rate budget",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, and reconcile again (warm) whenever the input spreadsheets change",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=f"`run`/`apply` only: replay the unfinished operations recorded in {JOURNAL_PATH}",
+    )
+    args = parser.parse_args()
+    if args.profile or args.profile_dir:
+        PROFILER.enable(args.profile_dir)
+    if args.command in ("unit", "student"):
+        if not args.target:
+            parser.error(f"`{args.command}` needs a TARGET")
+        if args.command == "unit":
+            finish(args, query_unit(args.target, offline=args.offline))
+        finish(args, query_student(args.target))
+    if args.target:
+        parser.error(f"`{args.command}` takes no TARGET")
+    if args.command == "match" and args.stream:
+        parser.error("`match` needs the whole sheets, not --stream")
+    if args.resume and args.command not in ("run", "apply"):
+        parser.error(f"`{args.command}` never sends changes, --resume needs `run` or `apply`")
+    if args.command == "diff":
+        APPLY_CHANGES = False
+    if args.batch and args.stream:
+        parser.error("--batch and --stream cannot be combined")
+    if args.watch and (args.batch or args.stream or args.enrolments_file):
+        parser.error("--watch works on the single enrolment/unit file pair")
+    if args.shards > 1 and (args.watch or args.enrolments_file):
+        parser.error("--shards applies to the API fetch of a one-shot run")
+
+    if args.resume:
+        remaining = EnrolmentJournal.pending()
+        if remaining is None:
+            print(f"❌ No journal at {JOURNAL_PATH}, nothing to resume")
+            finish(args, 1)
+        print(
+            f"🔁 Resuming: {len(remaining['enrol'])} enrol, "
+            f"{len(remaining['unenrol'])} unenrol operations left"
+        )
+        client = get_client()
+        journal = EnrolmentJournal()
+        with PROFILER.stage("apply"):
+            apply_changes(client, remaining["enrol"], remaining["unenrol"], journal)
+        journal.close()
+        finish(args)
+
+    if args.command == "apply":
+        if not os.path.exists(args.plan):
+            print(f"❌ No plan at {args.plan}, run `diff` first")
+            finish(args, 1)
+        client = get_client()
+        failed = apply_plan(client, args.plan, precheck=not args.no_precheck)
+        finish(args, 1 if failed else 0)
+
+    if args.watch:
+        client = get_client()
+        cache = IdCache(os.path.join(CACHE_DIR, "id_cache.sqlite3"), refresh=args.refresh)
+        pipeline = WarmPipeline(
+            client, cache, file_path_current_enrolled_modules, file_path_unit_creation,
+            args.output_format,
+        )
+        try:
+            watch(pipeline, [file_path_current_enrolled_modules, file_path_unit_creation])
+        except KeyboardInterrupt:
+            print("\n👋 Stopped watching")
+        finish(args)
+
+    if args.batch:
+        jobs = load_manifest(args.batch)
+        input_paths = [path for job in jobs for path in (job["current"], job["unit"])]
+    else:
+        input_paths = [file_path_current_enrolled_modules, file_path_unit_creation]
+    if args.enrolments_file:
+        input_paths.append(args.enrolments_file)
+    inputs = {path: file_sha256(path) for path in input_paths}
+    state = load_delta_state() if args.delta else None
+    if state is not None and state["inputs"] == inputs:
+        print("✅ Inputs unchanged since the last run, nothing to do")
+        finish(args)
+
+    if args.batch:
+        with PROFILER.stage("match_jobs"):
+            matched = run_match_jobs(jobs)
+        for name, (_, job_df) in matched.items():
+            print(f"✅ {name}: {len(job_df)} matched enrolments")
+        unit_shortnames = list(dict.fromkeys(s for shortnames, _ in matched.values() for s in shortnames))
+    else:
+        with PROFILER.stage("load_units"):
+            df_unit = load_sheet(file_path_unit_creation, UNIT_COLUMNS)
+        unit_shortnames = df_unit["shortname"].dropna().unique().tolist()
+        if not args.stream:
+            with PROFILER.stage("load_current"):
+                df_current = load_sheet(file_path_current_enrolled_modules, CURRENT_COLUMNS)
+            with PROFILER.stage("match"):
+                final_df = match_enrolments(df_current, df_unit)
+
+    if not args.stream:
+        matched_df = pd.concat([df for _, df in matched.values()]) if args.batch else final_df
+        with PROFILER.stage("index"):
+            save_unit_index(matched_df, unit_shortnames, inputs)
+    if args.command == "match":
+        os.makedirs("result", exist_ok=True)
+        matched_df.to_csv("./result/matched.csv", index=False)
+        print(f"💾 Save matched.csv ({len(matched_df)} enrolments) and the unit index")
+        finish(args)
+
+    # =========================================================
+    # Step 1. get course_id
+    # =========================================================
+    client = get_client()
+    cache = IdCache(os.path.join(CACHE_DIR, "id_cache.sqlite3"), refresh=args.refresh)
+    with PROFILER.stage("course_ids"):
+        course_map = fetch_course_ids(client, unit_shortnames, cache)
+
+    print(f"✅ Successfully get {len(course_map)} unit ID")
+
+    # =========================================================
+    # Step 2. construct target enrolment data
+    # =========================================================
+    with PROFILER.stage("target"):
+        if args.batch:
+            target_enrol = merge_target_enrol(
+                build_target_enrol(job_df, course_map) for _, job_df in matched.values()
+            )
+        elif args.stream:
+            target_enrol = stream_target_enrol(
+                file_path_current_enrolled_modules, build_module_dict(df_unit), course_map
+            )
+        else:
+            target_enrol = build_target_enrol(final_df, course_map)
+
+    # =========================================================
+    # Step 3. get enrolled users
+    # =========================================================
+    affected = affected_courses(state, course_map, target_enrol)
+    fetch_map = {s: c for s, c in course_map.items() if c in affected}
+    if args.delta:
+        print(f"🔁 Delta: {len(fetch_map)} of {len(course_map)} units affected")
+    if args.shards > 1:
+        # Steps 3 and 4 together: each worker fetches and diffs its own shard of courses
+        writers, write_course = open_result_sink(args.output_format)
+        with PROFILER.stage("sharded"):
+            fetched, to_enrol, to_unenrol = reconcile_sharded(
+                client, fetch_map, target_enrol, args.shards, on_course=write_course
+            )
+        close_result_sink(writers, to_enrol, to_unenrol)
+    else:
+        with PROFILER.stage("enrolled"):
+            if args.enrolments_file:
+                enrolled_data, export_user_ids = load_enrolled_emails(args.enrolments_file, fetch_map)
+                # known user IDs go straight into the cache, so Step 5 only looks up newcomers
+                cache.put_many("user", export_user_ids, USER_CACHE_TTL)
+                print(f"📂 Read enrolments of {len(enrolled_data)} units from {args.enrolments_file}")
+            else:
+                enrolled_data = fetch_enrolled_emails(client, fetch_map)
+
+        # =========================================================
+        # Step 4. compare and generate enrol/unenrol lists
+        # =========================================================
+        # a course whose fetch failed is not "nobody enrolled": leave it out of the diff
+        fetched_map = {s: c for s, c in fetch_map.items() if c in enrolled_data}
+        if len(fetched_map) < len(fetch_map):
+            print(f"⚠️ {len(fetch_map) - len(fetched_map)} units not diffed, their enrolments could not be fetched")
+        to_enrol, to_unenrol = write_diff(fetched_map, enrolled_data, target_enrol, args.output_format)
+        fetched = enrolled_data.keys()
+
+    # =========================================================
+    # Step 5. Execute enrolment changes
+    # =========================================================
+    outcomes = apply_diff(client, cache, to_enrol, to_unenrol)
+
+    # a course is only "done" once nothing is left to apply: failed fetches,
+    # dry-run diffs and failed or unresolved operations are diffed again by
+    # the next delta run, so their records reach its results and plan
+    pending = unsettled_courses(to_enrol, to_unenrol, outcomes)
+    reconciled = set(fetched) - pending
+    complete = set(fetch_map.values()) <= reconciled
+    with PROFILER.stage("save_state"):
+        save_delta_state(
+            next_delta_state(state, inputs if complete else None, target_enrol, reconciled, pending)
+        )
+
+    finish(args)